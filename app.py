@@ -1,12 +1,32 @@
-import os
+import hashlib
 import json
+import os
+import queue
+import threading
 import time
-import xml.etree.ElementTree as ET
-from flask import Flask, redirect, request, session, url_for, render_template_string
-from google.oauth2.credentials import Credentials
+from flask import Flask, Response, g, jsonify, redirect, request, session, stream_with_context, url_for, render_template
+from flask import before_render_template, template_rendered
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from markupsafe import escape
 import google.generativeai as genai
+from cache import ClassificationCache
+from checkpoints import CheckpointStore
+from dedup import Deduplicator
+from classifier import PROMPT_VERSION, AsyncClassifier, parse_stats, token_usage
+from gmail import fetch_messages, sync_inbox
+from gmail_clients import GmailClients, TokenStore, credentials_to_dict
+from jobs import JobManager
+from local_model import LocalModel
+from sessions import ServerSideSessionInterface, store_from_env
+from metrics import metrics, server_timing
+from rate_limiter import RateLimiter, RateLimitedModel
+from resilience import CircuitBreaker, CircuitBreakerModel, HedgedModel
+from rules import RuleClassifier, load_rules
+from scheduler import InboxScheduler
+from storage import MessageStore
+from threads import group_messages, thread_items
+from uploads import BACKUP_READ_ERRORS, UploadStore, file_sha256, open_backup
+from sms_reader import iter_sms
 
 # --- 1. CONFIGURATION ---
 app = Flask(__name__)
@@ -23,299 +43,287 @@ SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 # (1) This is the key you got from Google AI Studio
 # (1) This key will be read from Render's Environment Variables
 GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+# (2) This is the model name we found with check_models.py
+GEMINI_MODEL_NAME = 'models/gemini-2.5-flash'
+# (Optional) A cheaper model to use while the main one keeps failing
+GEMINI_FALLBACK_MODEL = os.environ.get('GEMINI_FALLBACK_MODEL')
+
+# Seconds one Gemini attempt may take, and whether the slowest calls are
+# sent twice (GEMINI_HEDGE=0 turns that off). See resilience.py.
+GEMINI_DEADLINE = float(os.environ.get('GEMINI_DEADLINE', 30))
+GEMINI_HEDGE = os.environ.get('GEMINI_HEDGE', '1') != '0'
+gemini_breaker = CircuitBreaker.from_env()
+gemini_attempts = {}  # {model name: HedgedModel}, for /metrics
+
+
+def limited_model(name, raw_model, limiter, breaker=None):
+    """Deadline and hedging for each attempt, under the rate limiter's retries.
+
+    The limiter also pays for the hedges, so they stay within the quota, and
+    `breaker` hears about every attempt (so retries stop once it opens).
+    """
+    hedged = gemini_attempts[name] = HedgedModel(
+        raw_model,
+        deadline=GEMINI_DEADLINE,
+        hedge_quantile=0.95 if GEMINI_HEDGE else None,
+        name=name,
+        limiter=limiter,
+        breaker=breaker,
+    )
+    return RateLimitedModel(hedged, limiter)
+
+
 try:
     genai.configure(api_key=GEMINI_API_KEY)
-    # (2) This is the model name we found with check_models.py
-    model = genai.GenerativeModel('models/gemini-2.5-flash') 
+    # (3) Every call goes through one shared rate limiter (see rate_limiter.py)
+    #     Set GEMINI_RPM / GEMINI_TPM for your quota, and GEMINI_RATE_FILE to
+    #     share the budget between gunicorn workers.
+    # (4) ...and a circuit breaker: when Gemini keeps failing, calls fail
+    #     fast (or go to GEMINI_FALLBACK_MODEL) for a while.
+    model = CircuitBreakerModel(
+        limited_model(GEMINI_MODEL_NAME, genai.GenerativeModel(GEMINI_MODEL_NAME), RateLimiter.from_env(),
+                      breaker=gemini_breaker),
+        gemini_breaker,
+        fallback=limited_model(
+            GEMINI_FALLBACK_MODEL, genai.GenerativeModel(GEMINI_FALLBACK_MODEL), RateLimiter.from_env()
+        ) if GEMINI_FALLBACK_MODEL else None,
+    )
 except Exception as e:
     print(f"Error configuring Gemini: {e}")
     model = None
-    
+
+# Answers we already got from Gemini are saved here (see cache.py), so the
+# same email or SMS is never sent twice.
+CACHE_PATH = os.environ.get('CLASSIFICATION_CACHE_PATH', 'classification_cache.db')
+classification_cache = ClassificationCache(CACHE_PATH, namespace=f"v{PROMPT_VERSION}:{GEMINI_MODEL_NAME}")
+
+# Obvious messages (OTP codes, bank alerts, promotions) are sorted by local
+# rules without asking Gemini (see rules.py). Point RULES_PATH at a JSON
+# file to use your own rules.
+local_rules = RuleClassifier(load_rules(os.environ.get('RULES_PATH')))
+
+# Templated messages from one sender that only differ in digits or names
+# are sent to Gemini once per group (see dedup.py). DEDUP_SIMILARITY=1
+# only groups exact copies (after masking digits, links and addresses).
+near_duplicates = Deduplicator(float(os.environ.get('DEDUP_SIMILARITY', 0.8)))
+
+# A small offline model learns from every Gemini answer (see local_model.py).
+# It answers what it is LOCAL_MODEL_CONFIDENCE sure about (1 = never) once it
+# has seen LOCAL_MODEL_MIN_EXAMPLES answers, and when Gemini fails (quota,
+# outage, timeout) its guesses stand in for the errors.
+local_model = LocalModel(
+    os.environ.get('LOCAL_MODEL_PATH', 'local_model.json'),
+    confidence=float(os.environ.get('LOCAL_MODEL_CONFIDENCE', 0.9)),
+    min_examples=int(os.environ.get('LOCAL_MODEL_MIN_EXAMPLES', 500)),
+)
+
+# Batches are sent to Gemini concurrently (see AsyncClassifier in classifier.py)
+GEMINI_MAX_IN_FLIGHT = int(os.environ.get('GEMINI_MAX_IN_FLIGHT', 4))
+GEMINI_CALL_TIMEOUT = float(os.environ.get('GEMINI_CALL_TIMEOUT', 60))
+engine = AsyncClassifier(model, max_in_flight=GEMINI_MAX_IN_FLIGHT, call_timeout=GEMINI_CALL_TIMEOUT) if model else None
+
+
+def conversation_items(user, kind, items):
+    """Groups items into conversations (see threads.py): one item to classify per conversation."""
+    keys = {key for key, _ in group_messages(kind, items)}
+    return thread_items(kind, items, message_store.latest_threads(user, kind, keys))
+
+
+def iter_classified_cards(user, kind, items):
+    """Classifies items and saves them for this user.
+
+    Yields (position in items, bucket, html) as soon as each card is ready:
+    first the messages already in the message store, then each batch as
+    Gemini answers it.
+    """
+    with metrics.span('store_lookup'):
+        stored = message_store.get_many(user, kind, [item['id'] for item in items])
+    metrics.inc('ai_inbox_store_hits_total', len(stored), kind=kind)
+    make_card = email_card if kind == 'email' else sms_card
+    positions = {item['id']: position for position, item in enumerate(items)}
+
+    new_items = []
+    for item in items:
+        if item['id'] in stored:
+            yield (positions[item['id']],) + make_card(item, stored_result(stored[item['id']]))
+        else:
+            new_items.append(item)
+    save_thread_progress(user, kind, [item for item in items if item['id'] in stored])
+
+    if not new_items:
+        return
+
+    by_id = {item['id']: item for item in new_items}
+    for results in engine.iter_classify(kind, new_items, cache=classification_cache, rules=local_rules,
+                                       dedup=near_duplicates, local_model=local_model):
+        new_rows = []
+        cards = []
+        for message_id, data in results.items():
+            item = by_id[message_id]
+            bucket, html = make_card(item, data)
+            cards.append((positions[message_id], bucket, html))
+            # Errors and the offline model's guesses are asked again next time
+            if 'error' not in data and 'fallback' not in data:
+                new_rows.append({
+                    'message_id': message_id,
+                    'sender': item['sender'],
+                    'from_name': str(data.get('from', item['sender'])),
+                    'summary': str(data.get('summary', 'Could not summarize.')),
+                    'priority': bucket,
+                    'received_at': item.get('received_at'),
+                })
+        message_store.save_many(user, kind, new_rows)
+        save_thread_progress(user, kind, [by_id[row['message_id']] for row in new_rows])
+        yield from sorted(cards)
+
+
+def save_thread_progress(user, kind, items):
+    """Remembers how far each conversation has been summarized (see threads.py)."""
+    message_store.save_threads(user, kind, [
+        {'thread_key': item['thread_key'], 'message_id': item['id'],
+         'first_at': item['first_at'], 'last_at': item['last_at']}
+        for item in items if 'thread_key' in item
+    ])
+
+
+def stored_result(row):
+    """A message store row, in the shape the classifier returns."""
+    return {'priority': row['priority'], 'from': row['from_name'], 'summary': row['summary']}
+
+
+def classify_cards(user, kind, items):
+    """Like iter_classified_cards(), but waits for all of them; returns [(bucket, html)] in order."""
+    cards = sorted(iter_classified_cards(user, kind, items))
+    return [(bucket, html) for _, bucket, html in cards]
+
+
+# SMS uploads are classified in the background (see jobs.py)
+SMS_BUCKETS = ['urgent', 'important', 'other']
+# The full-archive mode reads this many SMS at a time, so most conversations
+# are grouped whole (one that goes on in the next chunk continues from its
+# summary, see threads.py)
+SMS_ARCHIVE_CHUNK = 200
+
+# Uploaded backups are written to disk as they arrive (see uploads.py), and
+# big ones are sent in resumable chunks by static/upload.js
+sms_uploads = UploadStore(os.environ.get('UPLOAD_DIR', 'sms_uploads'))
+sms_jobs = JobManager(max_workers=int(os.environ.get('JOB_WORKERS', 4)))
+
+# The "whole inbox" mode pages through Gmail 500 emails at a time, and saves
+# its progress in the database so it can resume (see checkpoints.py)
+EMAIL_BUCKETS = ['high', 'medium', 'low', 'alert']
+ARCHIVE_PAGE_SIZE = 500
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'ai_inbox.db')
+checkpoints = CheckpointStore(DATABASE_PATH)
+
+# Sessions are kept on the server (see sessions.py); the cookie only holds
+# a random session ID. Set SESSION_BACKEND=filesystem to keep them as files.
+app.session_interface = ServerSideSessionInterface(store_from_env(DATABASE_PATH))
+
+# Every classified email and SMS is kept here, so pages can be drawn
+# (and filtered) without asking Gmail or Gemini again (see storage.py)
+message_store = MessageStore(DATABASE_PATH)
+
+# Each user's Gmail client is built once and kept (see gmail_clients.py);
+# their OAuth tokens live in the database so refreshed ones are not lost.
+gmail_clients = GmailClients(
+    TokenStore(DATABASE_PATH),
+    max_users=int(os.environ.get('GMAIL_CLIENT_CACHE_SIZE', 200)),
+)
+HISTORY_LIMIT = 100
+archive_jobs = JobManager(max_workers=int(os.environ.get('ARCHIVE_WORKERS', 2)))
+
 
 # --- 3. HTML TEMPLATES (Our "Website") ---
+#
+# The pages live in templates/ (all extending base.html), and the CSS and
+# JavaScript they share in static/. Flask compiles each template once and
+# keeps it, and the browser keeps style.css / tabs.js for a year: their
+# URLs carry a hash of the file (see static_url), so a new version gets a
+# new URL.
+
+# Keep the HTML small when a tab holds hundreds of cards
+app.jinja_env.trim_blocks = True
+app.jinja_env.lstrip_blocks = True
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 365 * 24 * 3600
+
+# The email and SMS results pages are the same template (priority_tabs.html)
+# with different tabs. Each tab's `bucket` matches EMAIL_BUCKETS / SMS_BUCKETS,
+# and `color` picks the tab's color in style.css.
+RESULTS_PAGES = {
+    'email': {
+        'title': 'Your Summaries',
+        'back_label': 'Go Back',
+        'progress': 'Looking through your inbox...',
+        'noun': 'emails',
+        'tabs': [
+            {'bucket': 'high', 'color': 'high', 'label': '🔥 High Priority', 'heading': 'High Priority',
+             'empty': 'No high priority emails found.'},
+            {'bucket': 'medium', 'color': 'medium', 'label': '🟠 Medium Priority', 'heading': 'Medium Priority',
+             'empty': 'No medium priority emails found.'},
+            {'bucket': 'low', 'color': 'low', 'label': '🟢 Low Priority', 'heading': 'Low Priority',
+             'empty': 'No low priority emails found.'},
+            {'bucket': 'alert', 'color': 'alert', 'label': '🔔 Alerts', 'heading': 'Alerts & Notifications',
+             'empty': 'No alerts or notifications found.'},
+        ],
+    },
+    'sms': {
+        'title': 'Your SMS Summaries',
+        'back_label': 'Go Back Home',
+        'progress': 'Reading your SMS file...',
+        'noun': 'messages',
+        'tabs': [
+            {'bucket': 'urgent', 'color': 'high', 'label': '🔥 Urgent', 'heading': 'Urgent',
+             'empty': 'No urgent messages found.'},
+            {'bucket': 'important', 'color': 'medium', 'label': '🟠 Important', 'heading': 'Important',
+             'empty': 'No important messages found.'},
+            {'bucket': 'other', 'color': 'low', 'label': '🟢 Other', 'heading': 'Other',
+             'empty': 'No other messages found.'},
+        ],
+    },
+}
+
+_static_versions = {}
+
+
+@app.context_processor
+def template_helpers():
+    return {'static_url': static_url}
+
+
+def static_url(filename):
+    """URL of a file in static/, with a hash of its contents so browsers can cache it for good."""
+    version = _static_versions.get(filename)
+    if version is None or app.debug:
+        with open(os.path.join(app.static_folder, filename), 'rb') as f:
+            version = _static_versions[filename] = hashlib.sha1(f.read()).hexdigest()[:12]
+    return url_for('static', filename=filename, v=version)
+
+
+def render_results(kind, cards=None, job_id=None, stream_url=None, updated=None, refresh_url=None):
+    """Renders the email or SMS results page; `cards` is {bucket: [html, ...]}.
+
+    `updated` ("5 minutes ago") and `refresh_url` are for pages showing
+    results that were worked out earlier.
+    """
+    return render_template(
+        'priority_tabs.html',
+        page=RESULTS_PAGES[kind],
+        cards=cards or {},
+        job_id=job_id,
+        stream_url=stream_url,
+        updated=updated,
+        refresh_url=refresh_url,
+    )
 
-# This is the new, creative login page
-HTML_HOME = """
-<html>
-<head>
-    <title>Email and SMS Summarizer</title>
-    <style>
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            height: 100vh;
-            margin: 0;
-            color: #333;
-        }
-        .container {
-            text-align: center;
-            background: #ffffff;
-            padding: 40px 50px;
-            border-radius: 12px;
-            box-shadow: 0 10px 30px rgba(0,0,0,0.1);
-            max-width: 450px;
-        }
-        h1 {
-            font-size: 2.2rem;
-            margin-bottom: 10px;
-        }
-        p {
-            color: #666;
-            font-size: 1.1rem;
-            margin-bottom: 30px;
-        }
-        .button {
-            display: inline-block;
-            padding: 15px 30px;
-            border-radius: 8px;
-            text-decoration: none;
-            font-weight: bold;
-            font-size: 1.1rem;
-            transition: all 0.3s ease;
-            cursor: pointer;
-        }
-        .login-btn {
-            background-color: #4285F4; /* Google Blue */
-            color: #fff;
-        }
-        .login-btn:hover {
-            background-color: #357ae8;
-        }
-        .summaries-btn {
-            background-color: #00c853; /* Green */
-            color: #fff;
-            margin-bottom: 20px;
-        }
-        .summaries-btn:hover {
-            background-color: #00b04a;
-        }
-        .logout-link {
-            color: #999;
-            font-size: 0.9rem;
-            text-decoration: none;
-        }
-        .logout-link:hover {
-            text-decoration: underline;
-        }
-
-        .sms-btn {
-            background-color: #00796b; /* Teal */
-            color: #fff;
-            margin-bottom: 20px;
-        }
-        .sms-btn:hover {
-            background-color: #00695c;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        {% if credentials %}
-            <!-- LOGGED IN STATE -->
-            <h1>Welcome Back!</h1>
-            <p>Ready to check your email and sms priorities?</p>
-            <a href="/get-emails" class="button summaries-btn">Get your email Summaries </a>
-            <br>
-            <a href="/sms" class="button sms-btn">Summarize and priorities your SMS</a>
-            <br>
-            <a href="/logout" classs="logout-link">Log out</a>
-        {% else %}
-            <!-- LOGGED OUT STATE (The Login Page) -->
-            <h1>Email Summarizer</h1>
-            <p>Use AI to summarize and prioritize your inbox.</p>
-            <a href="/login" class="button login-btn">Log in with Google</a>
-        {% endif %}
-    </div>
-</body>
-</html>
-"""
-
-# This is the new, sorted summaries page with TABS
-HTML_SUMMARIES = """
-<html>
-<head>
-    <title>Your Summaries</title>
-    <style>
-        body { 
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif; 
-            background-color: #f4f7f6;
-            margin: 0;
-            padding: 30px;
-        }
-        .container {
-            max-width: 900px;
-            margin: 0 auto;
-            background: #fff;
-            border-radius: 8px;
-            box-shadow: 0 4px 12px rgba(0,0,0,0.05);
-            overflow: hidden; /* Contains the tabs */
-        }
-        .back-link {
-            display: inline-block;
-            margin: 20px 30px;
-            color: #555;
-            text-decoration: none;
-        }
-        .back-link:hover {
-            text-decoration: underline;
-        }
-        
-        /* --- Tab Styles --- */
-        .tab-bar {
-            display: flex;
-            background-color: #eee;
-        }
-        .tab-button {
-            background-color: #eee;
-            border: none;
-            outline: none;
-            cursor: pointer;
-            padding: 14px 20px;
-            transition: background-color 0.3s;
-            font-size: 1rem;
-            font-weight: 500;
-            color: #555;
-            flex-grow: 1;
-            text-align: center;
-        }
-        .tab-button:hover {
-            background-color: #ddd;
-        }
-        /* Active tab button style */
-        .tab-button.active {
-            background-color: #fff;
-            color: #D32F2F;
-            border-bottom: 3px solid #D32F2F;
-        }
-        /* Color themes for other tabs */
-        .tab-button.medium.active {
-            color: #F57C00;
-            border-bottom-color: #F57C00;
-        }
-        .tab-button.low.active {
-            color: #388E3C;
-            border-bottom-color: #388E3C;
-        }
-
-        .tab-button.alert.active {
-            color: #0288D1; /* A nice blue */
-            border-bottom-color: #0288D1;
-        }
-
-        /* --- Tab Content --- */
-        .tab-content {
-            padding: 20px 30px;
-            display: none; /* Hide all tabs by default */
-            animation: fadeIn 0.5s;
-        }
-        @keyframes fadeIn {
-            from { opacity: 0; }
-            to { opacity: 1; }
-        }
-        
-        .email { 
-            background: #f9f9f9;
-            border: 1px solid #e0e0e0; 
-            padding: 15px 20px; 
-            margin-bottom: 15px; 
-            border-radius: 8px; 
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <a href="/" class="back-link">&larr; Go Back</a>
-        
-        <!-- The Tab Bar -->
-        <div class="tab-bar">
-            <button class="tab-button high active" onclick="openTab(event, 'High')">🔥 High Priority</button>
-            <button class="tab-button medium" onclick="openTab(event, 'Medium')">🟠 Medium Priority</button>
-            <button class="tab-button low" onclick="openTab(event, 'Low')">🟢 Low Priority</button>
-            <button class="tab-button alert" onclick="openTab(event, 'Alert')">🔔 Alerts</button>  </div>
-        </div>
-
-        <!-- Tab Content for High Priority -->
-        <div id="High" class="tab-content" style="display: block;">
-            <h2>High Priority</h2>
-            {% if high_priority %}
-                {% for email in high_priority %}
-                    <div class="email">{{ email | safe }}</div>
-                {% endfor %}
-            {% else %}
-                <p>No high priority emails found.</p>
-            {% endif %}
-        </div>
-
-        <!-- Tab Content for Medium Priority -->
-        <div id="Medium" class="tab-content">
-            <h2>Medium Priority</h2>
-            {% if medium_priority %}
-                {% for email in medium_priority %}
-                    <div class="email">{{ email | safe }}</div>
-                {% endfor %}
-            {% else %}
-                <p>No medium priority emails found.</p>
-            {% endif %}
-        </div>
-
-        <!-- Tab Content for Low Priority -->
-        <div id="Low" class="tab-content">
-            <h2>Low Priority</h2>
-            {% if low_priority %}
-                {% for email in low_priority %}
-                    <div class="email">{{ email | safe }}</div>
-                {% endfor %}
-            {% else %}
-                <p>No low priority emails found.</p>
-            {% endif %}
-        </div>
-
-        <div id="Alert" class="tab-content">
-            <h2>Alerts &amp; Notifications</h2>
-            {% if alerts %}
-                {% for email in alerts %}
-                    <div class="email">{{ email | safe }}</div>
-                {% endfor %}
-            {% else %}
-                <p>No alerts or notifications found.</p>
-            {% endif %}
-        </div>
-    </div>
-
-    <!-- The JavaScript to make tabs work -->
-    <script>
-        function openTab(evt, tabName) {
-            // Get all tab content elements and hide them
-            let tabContent = document.getElementsByClassName("tab-content");
-            for (let i = 0; i < tabContent.length; i++) {
-                tabContent[i].style.display = "none";
-            }
-
-            // Get all tab button elements and remove the "active" class
-            let tabButtons = document.getElementsByClassName("tab-button");
-            for (let i = 0; i < tabButtons.length; i++) {
-                tabButtons[i].className = tabButtons[i].className.replace(" active", "");
-            }
-
-            // Show the current tab, and add an "active" class to the button that opened the tab
-            document.getElementById(tabName).style.display = "block";
-            evt.currentTarget.className += " active";
-        }
-    </script>
-</body>
-</html>
-"""
 
 # --- 4. FLASK ROUTES (The App's "Pages") ---
 
 @app.route('/')
 def index():
-    if 'credentials' in session:
-        return render_template_string(HTML_HOME, credentials=True)
-    return render_template_string(HTML_HOME, credentials=False)
+    if 'user' in session:
+        return render_template('home.html', credentials=True)
+    return render_template('home.html', credentials=False)
 
 @app.route('/login')
 def login():
@@ -340,387 +348,747 @@ def callback():
     flow.fetch_token(authorization_response=authorization_response)
 
     credentials = flow.credentials
-    session['credentials'] = {
-        'token': credentials.token,
-        'refresh_token': credentials.refresh_token,
-        'token_uri': credentials.token_uri,
-        'client_id': credentials.client_id,
-        'client_secret': credentials.client_secret,
-        'scopes': credentials.scopes
-    }
-    
+
+    # Find out who logged in, and keep their tokens on the server
+    service = gmail_clients.factory(credentials)
+    user = service.users().getProfile(userId='me').execute()['emailAddress']
+    gmail_clients.remember(user, credentials_to_dict(credentials))
+
+    # A fresh session ID for the logged in session
+    session.regenerate()
+    session.pop('state', None)
+    session['user'] = user
+
+    # Get their summaries ready before they ask for them
+    inbox_scheduler.trigger(user)
+
     return redirect(url_for('index'))
 
 @app.route('/logout')
 def logout():
-    session.pop('credentials', None)
+    user = session.pop('user', None)
+    if user:
+        gmail_clients.forget(user)
+    session.clear()
     return redirect(url_for('index'))
 
 
 @app.route('/get-emails')
 def get_emails():
-    """Fetches, summarizes, and displays emails, sorted by priority."""
-    if 'credentials' not in session:
+    """Shows the summaries page; the emails are streamed into it by /get-emails/stream."""
+    if 'user' not in session:
         return redirect(url_for('login'))
         
     if not model:
         return "Gemini AI model is not configured. Check your API key and model name in app.py."
 
-    # --- 1. Create lists to hold sorted emails ---
-    high_priority_emails = []
-    medium_priority_emails = []
-    low_priority_emails = []
-    alert_emails = []
+    # Usually the scheduler has already classified the inbox, so just read it.
+    # "Refresh now" (?refresh=1), or nothing stored yet: do it live instead.
+    if not request.args.get('refresh'):
+        cards, synced_at = precomputed_email_cards(session['user'])
+        if cards is not None:
+            return render_results(
+                'email',
+                cards=cards,
+                updated=time_ago(synced_at),
+                refresh_url=url_for('get_emails', refresh=1),
+            )
+
+    return render_results('email', stream_url=url_for('stream_emails'))
+
+
+def precomputed_email_cards(user):
+    """Returns ({bucket: [html]}, synced_at) for the stored inbox snapshot, or (None, None)
+    if there is none yet or some of its emails were never classified."""
+    state = checkpoints.get(user, 'gmail_sync')
+    messages = state.get('messages')
+    if not messages:
+        return None, None
+
+    items = conversation_items(user, 'email', [email_item(msg) for msg in messages])
+    stored = message_store.get_many(user, 'email', [item['id'] for item in items])
+    if len(stored) < len(items):
+        return None, None
+
+    cards = {bucket: [] for bucket in EMAIL_BUCKETS}
+    for item in items:
+        bucket, html = email_card(item, stored_result(stored[item['id']]))
+        cards[bucket].append(html)
+    return cards, state.get('synced_at')
+
+
+def time_ago(timestamp):
+    """'just now', '5 minutes ago', '3 hours ago'..."""
+    if not timestamp:
+        return 'a while ago'
+    minutes = int((time.time() - timestamp) // 60)
+    if minutes < 1:
+        return 'just now'
+    if minutes < 60:
+        return f"{minutes} minute{'s' if minutes != 1 else ''} ago"
+    hours = minutes // 60
+    return f"{hours} hour{'s' if hours != 1 else ''} ago"
+
+
+@app.route('/get-emails/stream')
+def stream_emails():
+    """Fetches and summarizes emails, sending each card to the page as soon as it is ready.
+
+    This is a Server-Sent Events stream: every card is one "card" event, and
+    a final "done" (or "failure") event tells the page to stop listening.
+    """
+    if 'user' not in session:
+        return "Not logged in.", 401
+
+    if not model:
+        return "Gemini AI model is not configured.", 503
 
     try:
-        creds = Credentials(**session['credentials'])
-        service = build('gmail', 'v1', credentials=creds)
-        
-        # Get 20 most recent emails from the INBOX (read or unread)
-        result = service.users().messages().list(
-            userId='me', 
-            labelIds=['INBOX'], 
-            maxResults=20
-        ).execute()
-        
-        messages = result.get('messages', [])
-    
+        # (Must happen before streaming starts, because it may update the session)
+        service, user = gmail_service()
     except Exception as e:
-        return f"An error occurred fetching emails from GMail: {e}"
-    
-    if not messages:
-        return render_template_string(
-            HTML_SUMMARIES, 
-            high_priority=[], 
-            medium_priority=[], 
-            low_priority=["No emails found in your inbox."]
-        )
-        
-    for msg in messages:
-        try:
-            msg_data = service.users().messages().get(userId='me', id=msg['id']).execute()
-            
-            sender = ""
-            for header in msg_data['payload']['headers']:
-                if header['name'] == 'From':
-                    sender = header['value']
-                    break
-            
-            snippet = msg_data['snippet']
-            
-            # --- 2. Ask the AI for JSON, not plain text ---
-            prompt = f"""
-            Analyze the following email snippet and sender.
-            First, check if it is an urgent notification (like a bank alert, 2FA code, password reset, or payment confirmation). If it is, classify it as "Alert".
-            
-            If it is not an Alert, then classify its priority as "High", "Medium", or "Low" based on its general importance.
-
-            Respond ONLY with a valid JSON object in this format:
-            {{"priority": "Alert" or "High" or "Medium" or "Low", "from": "Sender Name", "summary": "One-sentence summary"}}
-            
-            ---
-            Email from: {sender}
-            Snippet: {snippet}
-            ---
-            """
-            
-            response = model.generate_content(prompt)
-            
-            # Clean up the response to make sure it's valid JSON
-            clean_json_str = response.text.strip().replace("```json", "").replace("```", "")
-            
-            # Parse the JSON string into a Python dictionary
-            data = json.loads(clean_json_str)
-            
-            # Get the data from the dictionary
-            priority = data.get('priority', 'Low').lower()
-            from_sender = data.get('from', sender) # Use AI's "from" or our "from"
-            summary = data.get('summary', 'Could not summarize.')
-
-            # Format the email as an HTML string
-            email_html = f"<b>From:</b> {from_sender}<br><b>Summary:</b> {summary}"
-
-            # --- 3. Sort the email into the correct list ---
-            if priority == 'alert':
-                alert_emails.append(email_html)
-            elif priority == 'high':
-                high_priority_emails.append(email_html)
-            elif priority == 'medium':
-                medium_priority_emails.append(email_html)
-            else:
-                low_priority_emails.append(email_html)
+        return f"An error occurred connecting to GMail: {e}", 502
 
+    def generate():
+        try:
+            # --- 1. Bring our copy of the 20 newest INBOX emails up to date ---
+            items, fetch_errors = sync_email_snapshot(service, user)
+            # One card per conversation
+            items = conversation_items(user, 'email', items)
         except Exception as e:
-            # If AI or JSON fails, just put it in "Low" priority
-            error_html = f"<b>Error processing email:</b> {e}<br><b>Snippet:</b> {snippet}"
-            low_priority_emails.append(error_html)
-            time.sleep(6)
-
-    # --- 4. Render the new HTML template with the 3 sorted lists ---
-    return render_template_string(
-        HTML_SUMMARIES, 
-        high_priority=high_priority_emails, 
-        medium_priority=medium_priority_emails, 
-        low_priority=low_priority_emails,
-        alerts=alert_emails
+            yield sse_event('failure', {'message': f"An error occurred fetching emails from GMail: {e}"})
+            return
+
+        total = len(items) + len(fetch_errors)
+        done = 0
+
+        if total == 0:
+            yield sse_event('card', {'bucket': 'low', 'html': "No emails found in your inbox.", 'position': 0, 'done': 0, 'total': 0})
+
+        for error in fetch_errors:
+            done += 1
+            yield sse_event('card', {
+                'bucket': 'low',
+                'html': f"<b>Error fetching email:</b> {escape(error['error'])}",
+                'position': total + done,
+                'done': done,
+                'total': total,
+            })
+
+        # --- 2. Send each card as soon as its batch comes back from the AI ---
+        for position, bucket, email_html in iter_classified_cards(user, 'email', items):
+            done += 1
+            yield sse_event('card', {'bucket': bucket, 'html': email_html, 'position': position, 'done': done, 'total': total})
+
+        # The Server-Timing header went out before the stream, so the breakdown comes last
+        done_event = {'total': total}
+        if SERVER_TIMING:
+            done_event['timings'] = {stage: round(seconds, 4) for stage, (seconds, _) in metrics.request_timings().items()}
+        yield sse_event('done', done_event)
+
+    return Response(
+        stream_with_context(with_keepalive(generate())),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
     )
 
-# --- 5. NEW SMS FEATURE CODE ---
 
-# This is the HTML for the SMS upload page
-HTML_SMS_UPLOAD = """
-<html>
-<head>
-    <title>SMS Summarizer</title>
-    <style>
-        /* (This is the same style as your other pages) */
-        body { 
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif; 
-            background-color: #f4f7f6;
-            margin: 0;
-            padding: 30px;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            min-height: 90vh;
-        }
-        .container {
-            max-width: 600px;
-            margin: 0 auto;
-            background: #fff;
-            border-radius: 8px;
-            box-shadow: 0 4px 12px rgba(0,0,0,0.05);
-            padding: 40px;
-            text-align: center;
-        }
-        .upload-form {
-            margin-top: 20px;
-        }
-        input[type="file"] {
-            margin-bottom: 20px;
-        }
-        .button {
-            display: inline-block;
-            padding: 15px 30px;
-            border-radius: 8px;
-            text-decoration: none;
-            font-weight: bold;
-            font-size: 1.1rem;
-            transition: all 0.3s ease;
-            cursor: pointer;
-            border: none;
-            background-color: #00796b;
-            color: white;
-        }
-        .button:hover {
-            background-color: #00695c;
-        }
-        .back-link {
-            display: inline-block;
-            margin-top: 20px;
-            color: #555;
-            text-decoration: none;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>Upload Your SMS File</h1>
-        <p>Please upload your <code>.xml</code> file from your SMS backup.</p>
-        <form action="/process-sms" method="post" enctype="multipart/form-data" class="upload-form">
-            <input type="file" name="sms_file" accept=".xml" required>
-            <br>
-            <button type="submit" class="button">Summarize My SMS</button>
-        </form>
-        <a href="/" class="back-link">&larr; Go Back Home</a>
-    </div>
-</body>
-</html>
-"""
-
-# This is the HTML for the SMS *results* page (copied from your email one)
-HTML_SMS_SUMMARIES = """
-<html>
-<head>
-    <title>Your SMS Summaries</title>
-    <style>
-        /* ... (Same CSS as HTML_SUMMARIES) ... */
-        body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Helvetica, Arial, sans-serif; background-color: #f4f7f6; margin: 0; padding: 30px; }
-        .container { max-width: 900px; margin: 0 auto; background: #fff; border-radius: 8px; box-shadow: 0 4px 12px rgba(0,0,0,0.05); overflow: hidden; }
-        .back-link { display: inline-block; margin: 20px 30px; color: #555; text-decoration: none; }
-        .back-link:hover { text-decoration: underline; }
-        .tab-bar { display: flex; background-color: #eee; }
-        .tab-button { background-color: #eee; border: none; outline: none; cursor: pointer; padding: 14px 20px; transition: background-color 0.3s; font-size: 1rem; font-weight: 500; color: #555; flex-grow: 1; text-align: center; }
-        .tab-button:hover { background-color: #ddd; }
-        .tab-button.active { background-color: #fff; color: #D32F2F; border-bottom: 3px solid #D32F2F; }
-        .tab-button.medium.active { color: #F57C00; border-bottom-color: #F57C00; }
-        .tab-button.low.active { color: #388E3C; border-bottom-color: #388E3C; }
-        .tab-content { padding: 20px 30px; display: none; animation: fadeIn 0.5s; }
-        @keyframes fadeIn { from { opacity: 0; } to { opacity: 1; } }
-        .email { background: #f9f9f9; border: 1px solid #e0e0e0; padding: 15px 20px; margin-bottom: 15px; border-radius: 8px; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <a href="/" class="back-link">&larr; Go Back Home</a>
-        
-        <div class="tab-bar">
-            <button class="tab-button high active" onclick="openTab(event, 'Urgent')">🔥 Urgent</button>
-            <button class="tab-button medium" onclick="openTab(event, 'Important')">🟠 Important</button>
-            <button class="tab-button low" onclick="openTab(event, 'Other')">🟢 Other</button>
-        </div>
-
-        <div id="Urgent" class="tab-content" style="display: block;">
-            <h2>Urgent</h2>
-            {% if urgent %}
-                {% for sms in urgent %}
-                    <div class="email">{{ sms | safe }}</div>
-                {% endfor %}
-            {% else %}
-                <p>No urgent messages found.</p>
-            {% endif %}
-        </div>
-
-        <div id="Important" class="tab-content">
-            <h2>Important</h2>
-            {% if important %}
-                {% for sms in important %}
-                    <div class="email">{{ sms | safe }}</div>
-                {% endfor %}
-            {% else %}
-                <p>No important messages found.</p>
-            {% endif %}
-        </div>
-
-        <div id="Other" class="tab-content">
-            <h2>Other</h2>
-            {% if other %}
-                {% for sms in other %}
-                    <div class="email">{{ sms | safe }}</div>
-                {% endfor %}
-            {% else %}
-                <p>No other messages found.</p>
-            {% endif %}
-        </div>
-    </div>
-
-    <script>
-        function openTab(evt, tabName) {
-            let tabContent = document.getElementsByClassName("tab-content");
-            for (let i = 0; i < tabContent.length; i++) {
-                tabContent[i].style.display = "none";
-            }
-            let tabButtons = document.getElementsByClassName("tab-button");
-            for (let i = 0; i < tabButtons.length; i++) {
-                tabButtons[i].className = tabButtons[i].className.replace(" active", "");
-            }
-            document.getElementById(tabName).style.display = "block";
-            evt.currentTarget.className += " active";
-        }
-    </script>
-</body>
-</html>
-"""
+def sync_email_snapshot(service, user):
+    """Brings our copy of the user's newest INBOX emails up to date.
+
+    Only what changed since last time is fetched (see gmail.sync_inbox).
+    Returns (items ready to classify, fetch errors).
+    """
+    state, fetch_errors = sync_inbox(service, checkpoints.get(user, 'gmail_sync'))
+    state['synced_at'] = time.time()
+    checkpoints.put(user, 'gmail_sync', state)
+    return [email_item(msg) for msg in state['messages']], fetch_errors
+
+
+def email_item(msg):
+    """A fetched email (see gmail.fetch_messages) as an item for the classifier."""
+    return {
+        'id': msg['id'],
+        'thread_id': msg.get('threadId'),
+        'sender': msg['sender'],
+        'text': msg['snippet'],
+        'received_at': msg.get('received_at'),
+    }
+
+
+def sse_event(name, data):
+    """Formats one Server-Sent Event."""
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+# Proxies drop a connection that stays quiet for too long (e.g. while a batch
+# waits for Gemini or the rate limiter), so streams send an SSE comment line
+# every SSE_KEEPALIVE seconds while they wait.
+SSE_KEEPALIVE = float(os.environ.get('SSE_KEEPALIVE', 15))
+
+
+def with_keepalive(events, interval=SSE_KEEPALIVE):
+    """Yields what `events` yields, plus ': keepalive' whenever it is quiet for `interval` seconds.
+
+    `events` runs in a thread of its own (keeping this request's timings),
+    so waiting for it can be interrupted. If the browser goes away, it is
+    closed after its current step.
+    """
+    output = queue.Queue()
+    stop = threading.Event()
+    timings = metrics.request_timings()
+
+    def produce():
+        metrics.start_request(timings)
+        try:
+            for event in events:
+                if stop.is_set():
+                    break
+                output.put(('event', event))
+            output.put(('end', None))
+        except Exception as e:
+            output.put(('error', e))
+        finally:
+            events.close()
+
+    threading.Thread(target=produce, name='sse-stream', daemon=True).start()
+    try:
+        while True:
+            try:
+                kind, value = output.get(timeout=interval)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if kind == 'end':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+    finally:
+        stop.set()
+
+
+# This route goes through the WHOLE inbox in the background (not just the newest 20).
+# It remembers how far it got, so later visits only look at new emails.
+@app.route('/archive-emails')
+def archive_emails():
+    if 'user' not in session:
+        return redirect(url_for('login'))
+
+    if not model:
+        return "Gemini AI model is not configured. Check your API key and model name in app.py."
+
+    try:
+        _, user = gmail_service()
+    except Exception as e:
+        return f"An error occurred connecting to GMail: {e}"
+
+    job = archive_jobs.submit(EMAIL_BUCKETS, run_email_archive, user, user=user)
+    return render_results('email', job_id=job.id)
+
+
+def gmail_service():
+    """Returns (Gmail client, email address) for the logged in user, from the per-user cache."""
+    user = session['user']
+    service = gmail_clients.get(user)
+    if service is None:
+        # Their tokens are gone (e.g. they logged out in another browser)
+        session.pop('user', None)
+        raise RuntimeError("Your Google login has expired, please log in again.")
+    return service, user
+
+
+def email_card(item, data):
+    """Turns one classified email into (bucket, html) for the results page."""
+    if 'error' in data:
+        # If AI or JSON fails, just put it in "Low" priority
+        return 'low', f"<b>Error processing email:</b> {escape(data['error'])}<br><b>Snippet:</b> {escape(item['text'])}"
+
+    # Get the data from the dictionary
+    priority = str(data.get('priority', 'Low')).lower()
+    from_sender = data.get('from', item['sender']) # Use AI's "from" or our "from"
+    summary = data.get('summary', 'Could not summarize.')
+
+    # Format the email as an HTML string (escaped: it is the sender's text, or the AI's)
+    email_html = f"<b>From:</b> {escape(from_sender)}{thread_note(item)}<br><b>Summary:</b> {escape(summary)}{fallback_note(data)}"
+
+    # --- Sort the email into the correct list ---
+    if priority in ('alert', 'high', 'medium'):
+        return priority, email_html
+    return 'low', email_html
+
+
+def thread_note(item):
+    """' (5 messages)' on the card of a whole conversation."""
+    count = item.get('count', 1)
+    return f" ({count} messages)" if count > 1 else ""
+
+
+def fallback_note(data):
+    """Marks a card sorted by the offline model because the AI was unavailable."""
+    if 'fallback' not in data:
+        return ""
+    return "<br><i>The AI is unavailable right now; this was sorted by the offline model.</i>"
+
+
+def classify_emails_into_job(job, service, user, message_ids):
+    """Fetches and classifies a list of message IDs, adding one card per conversation to the job.
+
+    Returns when the newest of these emails arrived (a Unix timestamp), or None.
+    """
+    fetched = fetch_messages(service, message_ids)
+
+    items = []
+    errors = []
+    for message_id in message_ids:
+        msg_data = fetched.get(message_id, {'error': 'Missing from the batch response.'})
+        if 'error' in msg_data:
+            errors.append(msg_data['error'])
+        else:
+            items.append(email_item(msg_data))
+    newest = max((item['received_at'] for item in items if item.get('received_at')), default=None)
+
+    items = conversation_items(user, 'email', items)
+    job.add_total(len(errors) + len(items))
+    for error in errors:
+        job.add('low', f"<b>Error fetching email:</b> {escape(error)}")
+
+    # The classifier batches these itself; each card is added as its batch lands
+    for _, bucket, email_html in iter_classified_cards(user, 'email', items):
+        job.add(bucket, email_html)
+    return newest
+
+
+def run_email_archive(job, user):
+    """Background job: page through the whole inbox, newest first.
+
+    The checkpoint remembers the Gmail page we are on (to resume after a
+    restart) and when the newest email of the last finished run arrived.
+    The next run only asks Gmail for emails received after that, so it
+    still stops in the right place if that email was deleted or archived.
+    """
+    # This thread's own client (they can't be shared between threads)
+    service = gmail_clients.get(user)
+
+    checkpoint = checkpoints.get(user, 'email_archive')
+    page_token = checkpoint.get('page_token')
+    if page_token:
+        # An unfinished run: carry on where it stopped (with the same search)
+        newer_than = checkpoint.get('newer_than')
+        run_newest = checkpoint.get('run_newest')
+    else:
+        newer_than = checkpoint.get('newest_at')
+        run_newest = None
+    # Gmail searches in whole seconds; an email seen twice is already in the message store
+    query = f"after:{int(newer_than) - 1}" if newer_than else None
+
+    job.start(total=0)
+    while True:
+        with metrics.span('gmail_list'):
+            result = service.users().messages().list(
+                userId='me',
+                labelIds=['INBOX'],
+                q=query,
+                maxResults=ARCHIVE_PAGE_SIZE,
+                pageToken=page_token
+            ).execute()
+
+        message_ids = [msg['id'] for msg in result.get('messages', [])]
+        newest = classify_emails_into_job(job, service, user, message_ids)
+        if newest is not None:
+            run_newest = max(run_newest or 0, newest)
+
+        page_token = result.get('nextPageToken')
+        if not page_token:
+            break
+        checkpoints.put(user, 'email_archive', {
+            'page_token': page_token,
+            'newer_than': newer_than,
+            'run_newest': run_newest,
+        })
+
+    # Finished! Next time only emails that arrived after the newest one are looked at
+    checkpoints.put(user, 'email_archive', {'newest_at': max(run_newest or 0, newer_than or 0) or None})
+
+# --- 5. NEW SMS FEATURE CODE ---
 
 # This new route shows the upload page
 @app.route('/sms')
 def sms_page():
     # We must be logged in to use the Gemini AI
-    if 'credentials' not in session:
+    if 'user' not in session:
         return redirect(url_for('login'))
-    return render_template_string(HTML_SMS_UPLOAD)
+    return render_template('sms_upload.html')
 
 
-# This new route *handles* the file upload and processing
+# This new route *handles* the file upload and processing.
+# The backup is either in the form (`sms_file`), or was sent earlier in
+# chunks (`upload_id`, see the /uploads routes below).
 @app.route('/process-sms', methods=['POST'])
 def process_sms():
-    if 'credentials' not in session:
+    if 'user' not in session:
         return redirect(url_for('login'))
-    
-    if 'sms_file' not in request.files:
+
+    upload_id = request.form.get('upload_id')
+    file = request.files.get('sms_file')
+    if not upload_id and (file is None or file.filename == ''):
         return "No file uploaded.", 400
-        
-    file = request.files['sms_file']
-    if file.filename == '':
-        return "No file selected.", 400
-        
+
     if not model:
         return "Gemini AI model is not configured. Check your API key."
 
-    # Create lists to hold sorted SMS
-    urgent_sms = []
-    important_sms = []
-    other_sms = []
-    
+    # Results are saved per user, so we need to know who you are
+    try:
+        _, user = gmail_service()
+    except Exception as e:
+        return f"An error occurred connecting to GMail: {e}"
+
+    if upload_id:
+        if sms_uploads.path(user, upload_id) is None:
+            return "That upload is missing or not finished yet.", 400
+    else:
+        # Copy the upload to disk now (the request's file goes away once
+        # we return), and do the slow part in the background.
+        upload_id = sms_uploads.save(user, file.stream, file.filename)
+
+    run = run_sms_archive if request.form.get('full_archive') else run_sms_job
+    job = sms_jobs.submit(SMS_BUCKETS, run_sms_upload, run, upload_id, user, user=user)
+
+    # --- Render the results page; it fills itself in as the job makes progress ---
+    return render_results('sms', job_id=job.id)
+
+
+# Resumable uploads: POST /uploads starts one, each PUT /uploads/<id> adds
+# the chunk that starts at its Upload-Offset header, and GET /uploads/<id>
+# tells how much has arrived (to carry on after a dropped connection).
+@app.route('/uploads', methods=['POST'])
+def start_upload():
+    if 'user' not in session:
+        return jsonify({'error': 'Not logged in.'}), 401
+    data = request.get_json(silent=True) or {}
+    size = data.get('size')
+    if not isinstance(size, int) or size <= 0:
+        return jsonify({'error': 'A positive size is needed.'}), 400
+    upload_id = sms_uploads.create(session['user'], str(data.get('filename') or 'backup.xml'), size)
+    return jsonify({'upload_id': upload_id, 'offset': 0}), 201
+
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PUT'])
+def upload_chunk(upload_id):
+    if 'user' not in session:
+        return jsonify({'error': 'Not logged in.'}), 401
+    user = session['user']
+    info = sms_uploads.info(user, upload_id)
+    if info is None:
+        return jsonify({'error': 'No such upload.'}), 404
+
+    if request.method == 'PUT':
+        offset = request.headers.get('Upload-Offset', type=int)
+        if offset is None:
+            return jsonify({'error': 'Missing Upload-Offset header.'}), 400
+        if offset != info['offset']:
+            # Not where the upload got to (e.g. a chunk sent twice): the client resumes from here
+            return jsonify({'offset': info['offset'], 'size': info['size']}), 409
+        info['offset'] = sms_uploads.append(user, upload_id, offset, request.stream)
+        if info['offset'] is None:
+            return jsonify({'error': 'No such upload.'}), 404
+
+    return jsonify({'offset': info['offset'], 'size': info['size']})
+
+
+# This new route lets the results page check on a background job.
+# The page passes how many cards it already shows (e.g. ?urgent=12&other=3),
+# so only the new ones are sent back. You can only see your own jobs.
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    if 'user' not in session:
+        return jsonify({'error': 'Not logged in.'}), 401
+    user = session['user']
+    job = sms_jobs.get(job_id, user) or archive_jobs.get(job_id, user)
+    if job is None:
+        return jsonify({'error': 'No such job.'}), 404
+    offsets = {bucket: request.args.get(bucket, 0, type=int) for bucket in job.results}
+    return jsonify(job.to_dict(offsets))
+
+
+def sms_card(item, data):
+    """Turns one classified SMS into (bucket, html) for the results page."""
+    if 'error' in data:
+        return 'other', f"<b>Error processing SMS:</b> {escape(data['error'])}<br><b>From:</b> {escape(item['sender'])}"
+
+    priority = str(data.get('priority', 'Other')).lower()
+    from_sender = data.get('from', item['sender'])
+    summary = data.get('summary', 'Could not summarize.')
+
+    sms_html = f"<b>From:</b> {escape(from_sender)}{thread_note(item)}<br><b>Summary:</b> {escape(summary)}{fallback_note(data)}"
+
+    # --- Sort the SMS into the correct list ---
+    if priority in ('urgent', 'important'):
+        return priority, sms_html
+    return 'other', sms_html
+
+
+def sms_item(msg):
+    """Turns the attributes of one <sms> into an item for the classifier.
+
+    The ID is a hash of the sender, date and text, so the same message in
+    a later backup gets the same ID (and is found in the message store).
+    """
+    sender = msg.get('address', 'Unknown')
+    text = msg.get('body', 'No content')
+    date = msg.get('date') or ''
+    message_id = hashlib.sha1(f"{sender}|{date}|{text}".encode('utf-8')).hexdigest()[:16]
+    return {
+        'id': message_id,
+        'sender': sender,
+        'text': text,
+        'received_at': int(date) / 1000 if date.isdigit() else None,
+        'sent': msg.get('type') == '2',  # 1 = received, 2 = sent by me
+    }
+
+
+def run_sms_upload(job, run, upload_id, user):
+    """Background job: run(job, path, user) on an uploaded backup, then delete the upload."""
+    path = sms_uploads.path(user, upload_id)
+    if path is None:
+        raise ValueError("The uploaded file is gone, please upload it again.")
+    try:
+        run(job, path, user)
+    finally:
+        sms_uploads.delete(upload_id)
+
+
+def run_sms_job(job, path, user):
+    """Background job: parse the SMS backup and classify it batch by batch."""
     sms_limit = 20 # Let's only process 10 to keep it fast
-    sms_count = 0
 
     try:
-        # Read the file and parse the XML
-        tree = ET.parse(file.stream)
-        root = tree.getroot()
-        
-        # This loops through each <sms> tag in your .xml file
+        # Stream through the XML; only the first `sms_limit` messages are ever read
         # (This assumes the common "SMS Backup & Restore" format)
-        for msg in root.iter('sms'):
-            if sms_count >= sms_limit:
-                break # Stop after we hit our limit
-                
-            try:
-                sender = msg.get('address', 'Unknown')
-                body = msg.get('body', 'No content')
-                
-                # --- Ask the AI to classify the SMS ---
-                prompt = f"""
-                Analyze the following SMS message. Classify its priority as "Urgent" (e.g., 2FA codes, bank alerts, emergency), "Important" (e.g., personal conversation, plans), or "Other" (e.g., spam, marketing, promotions).
-                
-                Respond ONLY with a valid JSON object in this format:
-                {{"priority": "Urgent" or "Important" or "Other", "from": "Sender", "summary": "One-sentence summary"}}
-                
-                ---
-                From: {sender}
-                Message: {body}
-                ---
-                """
-                
-                response = model.generate_content(prompt)
-                clean_json_str = response.text.strip().replace("```json", "").replace("```", "")
-                data = json.loads(clean_json_str)
-                
-                priority = data.get('priority', 'Other').lower()
-                from_sender = data.get('from', sender)
-                summary = data.get('summary', 'Could not summarize.')
-
-                sms_html = f"<b>From:</b> {from_sender}<br><b>Summary:</b> {summary}"
-
-                # --- Sort the SMS into the correct list ---
-                if priority == 'urgent':
-                    urgent_sms.append(sms_html)
-                elif priority == 'important':
-                    important_sms.append(sms_html)
-                else:
-                    other_sms.append(sms_html)
-                
-                time.sleep(6) # --- RATE LIMITING ---
-                sms_count += 1
-
-            except Exception as e:
-                error_html = f"<b>Error processing SMS:</b> {e}<br><b>From:</b> {sender}"
-                other_sms.append(error_html)
-                time.sleep(6) # --- RATE LIMITING ---
-                sms_count += 1
+        with open_backup(path) as source:
+            items = [sms_item(msg) for msg in iter_sms(source, limit=sms_limit)]
                 
     except Exception as e:
-        return f"Error reading XML file. Is it a valid SMS backup? Error: {e}"
-
-    # --- Render the new HTML template with the 3 sorted lists ---
-    return render_template_string(
-        HTML_SMS_SUMMARIES, 
-        urgent=urgent_sms, 
-        important=important_sms, 
-        other=other_sms
-    )
+        raise ValueError(f"Error reading XML file. Is it a valid SMS backup? Error: {e}")
+
+    # One card per conversation
+    items = conversation_items(user, 'sms', items)
+    job.start(total=len(items))
+
+    # --- Ask the AI; each card is added as its batch lands, so the page shows them right away ---
+    for _, bucket, sms_html in iter_classified_cards(user, 'sms', items):
+        job.add(bucket, sms_html)
+
+
+def run_sms_archive(job, path, user):
+    """Background job: classify EVERY message in the backup, not just the first 20.
+
+    After each chunk we save how many <sms> records of this file are done,
+    so uploading the same file again after a crash resumes from there.
+    Once a file is finished we remember the newest message date, and later
+    uploads (newer backups) skip everything up to that date.
+    """
+    file_id = file_sha256(path)
+    checkpoint = checkpoints.get(user, 'sms_archive')
+    newest_date = checkpoint.get('newest_date', 0)
+
+    if checkpoint.get('file_id') == file_id:
+        # Same file as an unfinished run: skip what it already did
+        skip = checkpoint['processed']
+        run_newest = checkpoint.get('run_newest_date', newest_date)
+    else:
+        skip = 0
+        run_newest = newest_date
+
+    job.start(total=0)
+    chunk = []
+    position = 0
+
+    def classify_chunk():
+        conversations = conversation_items(user, 'sms', chunk)
+        job.add_total(len(conversations))
+        for card in classify_cards(user, 'sms', conversations):
+            job.add(*card)
+        chunk.clear()
+        checkpoints.put(user, 'sms_archive', {
+            'newest_date': newest_date,
+            'file_id': file_id,
+            'processed': position,
+            'run_newest_date': run_newest,
+        })
+
+    source = open_backup(path)
+    try:
+        for position, msg in enumerate(iter_sms(source), start=1):
+            if position <= skip:
+                continue
+
+            date = msg.get('date') or ''
+            date = int(date) if date.isdigit() else 0
+            if date and date <= newest_date:
+                continue # Already handled by an earlier upload
+            run_newest = max(run_newest, date)
+
+            chunk.append(sms_item(msg))
+            if len(chunk) >= SMS_ARCHIVE_CHUNK:
+                classify_chunk()
+
+    except BACKUP_READ_ERRORS as e:
+        raise ValueError(f"Error reading XML file. Is it a valid SMS backup? Error: {e}")
+    finally:
+        source.close()
+
+    if chunk:
+        classify_chunk()
+
+    # Finished the whole file
+    checkpoints.put(user, 'sms_archive', {'newest_date': run_newest})
+
+# --- 6. HISTORY (read straight from the message store) ---
+
+# Shows every email or SMS we have ever classified for you, newest first.
+# Add ?sender=... to only see one sender.
+@app.route('/history/<source>')
+def history(source):
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    if source not in ('email', 'sms'):
+        return "Unknown history type.", 404
+
+    try:
+        _, user = gmail_service()
+    except Exception as e:
+        return f"An error occurred connecting to GMail: {e}"
+
+    sender = request.args.get('sender') or None
+    limit = max(1, min(request.args.get('limit', HISTORY_LIMIT, type=int), 1000))
+
+    buckets = EMAIL_BUCKETS if source == 'email' else SMS_BUCKETS
+    rows = message_store.by_priority(user, source, buckets, sender=sender, limit=limit)
+    cards = {bucket: [stored_card_html(row) for row in rows[bucket]] for bucket in buckets}
+    return render_results(source, cards=cards)
+
+
+def stored_card_html(row):
+    return f"<b>From:</b> {escape(row['from_name'])}<br><b>Summary:</b> {escape(row['summary'])}"
+
+
+# --- 7. METRICS ---
+#
+# Timings of every stage (Gmail, Gemini, parsing, rendering...) and a few
+# counters, in the Prometheus format at /metrics (see metrics.py).
+# Set SERVER_TIMING=1 to also get each response's own breakdown in a
+# Server-Timing header (browsers show it in the dev tools Network tab).
+
+SERVER_TIMING = os.environ.get('SERVER_TIMING') == '1'
+
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+
+
+@app.after_request
+def finish_timing(response):
+    elapsed = time.perf_counter() - g.pop('request_start', time.perf_counter())
+    endpoint = request.endpoint or 'unknown'
+    metrics.observe('ai_inbox_request_seconds', elapsed, endpoint=endpoint)
+    metrics.inc('ai_inbox_requests_total', endpoint=endpoint, status=response.status_code)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = server_timing(metrics.request_timings(), total=elapsed)
+    return response
+
+
+# Template rendering is timed with Flask's own signals
+@before_render_template.connect_via(app)
+def start_render(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def finish_render(sender, template, context, **extra):
+    start = g.pop('render_start', None)
+    if start is not None:
+        metrics.record('render', time.perf_counter() - start)
+
+
+def collect_app_stats():
+    """Numbers the other modules already keep, for /metrics."""
+    families = [
+        ('ai_inbox_parse_total', 'counter', 'Model answers parsed, by outcome.',
+         [({'outcome': name}, value) for name, value in parse_stats.snapshot().items() if name != 'failure_rate']),
+    ]
+
+    usage = token_usage.snapshot()
+    families.append(('ai_inbox_gemini_calls_total', 'counter', 'Gemini calls that got an answer.',
+                     [(call_labels(name), totals['calls']) for name, totals in usage.items()]))
+    families.append(('ai_inbox_gemini_tokens_total', 'counter', 'Gemini tokens used, by direction.',
+                     [(dict(call_labels(name), direction=direction), totals[direction + '_tokens'])
+                      for name, totals in usage.items() for direction in ('input', 'output')]))
+
+    rules = local_rules.stats()
+    families.append(('ai_inbox_rules_seen_total', 'counter', 'Messages checked against the local rules.',
+                     [({}, rules['seen'])]))
+    families.append(('ai_inbox_rule_hits_total', 'counter', 'Messages decided by a local rule.',
+                     [({'rule': name}, count) for name, count in rules['by_rule'].items()]))
+
+    families.append(('ai_inbox_circuit_breaker_open', 'gauge', '1 while Gemini calls are being refused.',
+                     [({}, 0 if gemini_breaker.state == 'closed' else 1)]))
+    families.append(('ai_inbox_gemini_hedge_delay_seconds', 'gauge',
+                     'How long a Gemini call may run before it is sent again (0 = not hedging yet).',
+                     [({'model': name}, hedged.hedge_delay() or 0) for name, hedged in gemini_attempts.items()]))
+    families.append(('ai_inbox_local_model_examples', 'gauge', 'Gemini answers the offline model has learned from.',
+                     [({'kind': kind}, count) for kind, count in local_model.stats().items()]))
+
+    duplicates = near_duplicates.stats()
+    families.append(('ai_inbox_dedup_seen_total', 'counter', 'Messages checked for near-duplicates.',
+                     [({}, duplicates['seen'])]))
+    families.append(('ai_inbox_dedup_duplicates_total', 'counter',
+                     'Messages answered through their near-duplicate group instead of Gemini.',
+                     [({}, duplicates['duplicates'])]))
+    return families
+
+
+def call_labels(name):
+    """'sms_batch' -> {'kind': 'sms', 'mode': 'batch'} (see TokenUsage in classifier.py)."""
+    kind, mode = name.split('_', 1)
+    return {'kind': kind, 'mode': mode}
+
+
+metrics.add_collector(collect_app_stats)
+
+
+@app.route('/metrics')
+def metrics_page():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# --- 8. BACKGROUND PRE-CLASSIFICATION ---
+#
+# Every PRECLASSIFY_INTERVAL seconds (0 = never), each user with a stored
+# refresh token gets their newest emails synced and classified in the background
+# (see scheduler.py), so /get-emails can just read the results.
+
+def preclassify_inbox(user):
+    service = gmail_clients.get(user)
+    if service is None or engine is None:
+        return  # Logged out meanwhile, or no AI configured
+    items, _ = sync_email_snapshot(service, user)
+    classify_cards(user, 'email', conversation_items(user, 'email', items))
+
+
+inbox_scheduler = InboxScheduler(
+    gmail_clients.store.users,
+    preclassify_inbox,
+    interval=float(os.environ.get('PRECLASSIFY_INTERVAL', 15 * 60)),
+    workers=int(os.environ.get('PRECLASSIFY_WORKERS', 2)),
+    runs_per_minute=float(os.environ.get('PRECLASSIFY_RUNS_PER_MINUTE', 30)),
+)
+# Started last, once everything it uses is defined
+inbox_scheduler.start()
+
 
-# --- 5. RUN THE APP ---
+# --- 9. RUN THE APP ---
 if __name__ == '__main__':
     app.run(port=5000, debug=True)
@@ -0,0 +1,238 @@
+"""End-to-end latency, throughput and peak memory of the app's routes, offline.
+
+Gemini and Gmail are replaced by the local fakes in fake_google.py, so this
+runs on a laptop with no credentials and no network. Each route and size
+runs in a fresh process (so peak RSS is per route), with fresh databases.
+
+    python benchmarks/bench_routes.py
+    python benchmarks/bench_routes.py --routes sms sms_archive --sizes 100 1000 \\
+        --gemini-latency 1.0 --rate-limit-rate 0.05 --runs 3
+
+Routes:
+    emails       GET /get-emails/stream (the newest 20 emails, read to the end)
+    archive      GET /archive-emails, then poll /jobs/<id> until it is done
+    sms          POST /process-sms (first 20 SMS), then poll the job
+    sms_archive  POST /process-sms with full_archive, then poll the job
+
+`size` is the number of emails in the fake inbox, or SMS in the backup.
+Every run uses a new user and an empty classification cache ("cold"),
+unless --warm is given.
+"""
+import argparse
+import io
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+ROUTES = ['emails', 'archive', 'sms', 'sms_archive']
+
+# How often the job routes are polled (the real page polls every 2 s)
+POLL_INTERVAL = 0.02
+
+# Every results tab of both pages (see EMAIL_BUCKETS / SMS_BUCKETS in app.py)
+ROUTE_BUCKETS = ['high', 'medium', 'low', 'alert', 'urgent', 'important', 'other']
+
+
+def percentile(values, p):
+    """The p-th percentile (0-100) of a list, by nearest rank."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+# --- CHILD PROCESS: one route, one size ---
+
+def load_app(args, workdir):
+    """Imports app.py with fresh databases and the fakes plugged in."""
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'ai_inbox.db')
+    os.environ['CLASSIFICATION_CACHE_PATH'] = os.path.join(workdir, 'classification_cache.db')
+    os.environ['LOCAL_MODEL_PATH'] = os.path.join(workdir, 'local_model.json')
+    os.environ['GEMINI_RPM'] = str(args.rpm)
+    os.environ['GEMINI_TPM'] = str(args.tpm)
+    os.environ.pop('GEMINI_RATE_FILE', None)
+    # Only the measured requests should do any work
+    os.environ['PRECLASSIFY_INTERVAL'] = '0'
+
+    import app
+    from cache import ClassificationCache
+    from classifier import AsyncClassifier
+    from fake_google import FakeGemini, FakeGmail
+    from rate_limiter import RateLimiter
+    from resilience import CircuitBreakerModel
+
+    gemini = FakeGemini(
+        latency=args.gemini_latency, jitter=args.gemini_jitter, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, retry_hint=args.retry_hint,
+    )
+    gmail = FakeGmail(inbox_size=args.size, latency=args.gmail_latency, error_rate=args.gmail_error_rate)
+
+    # The real breaker, hedging, limiter and async engine; only the model underneath is fake
+    app.model = CircuitBreakerModel(
+        app.limited_model('fake', gemini, RateLimiter(args.rpm, args.tpm)), app.gemini_breaker
+    )
+    app.engine = AsyncClassifier(app.model, max_in_flight=app.GEMINI_MAX_IN_FLIGHT, call_timeout=app.GEMINI_CALL_TIMEOUT)
+    app.gmail_clients.factory = lambda credentials: gmail
+    app.app.config['TESTING'] = True
+    return app, ClassificationCache, gemini, gmail
+
+
+def client_for(app, user):
+    """A test client logged in as `user`."""
+    app.gmail_clients.remember(user, {'token': 'fake'})
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['user'] = user
+    return client
+
+
+def wait_for_job(client, html):
+    """Polls /jobs/<id> (found in the results page) until the job is over; returns the item count."""
+    job_id = re.search(r'/jobs/([0-9a-f]+)', html).group(1)
+    while True:
+        status = client.get(f'/jobs/{job_id}?' + '&'.join(f'{b}=10000000' for b in ROUTE_BUCKETS)).get_json()
+        if status['status'] in ('done', 'error'):
+            if status['error']:
+                raise RuntimeError(status['error'])
+            return status['done']
+        time.sleep(POLL_INTERVAL)
+
+
+def run_route(route, client, sms_backup):
+    """Runs one request (and its background job); returns how many messages it classified."""
+    if route == 'emails':
+        body = client.get('/get-emails/stream').get_data(as_text=True)
+        if 'event: done' not in body:
+            raise RuntimeError(body[-500:])
+        return body.count('event: card')
+
+    if route == 'archive':
+        return wait_for_job(client, client.get('/archive-emails').get_data(as_text=True))
+
+    data = {'sms_file': (io.BytesIO(sms_backup), 'backup.xml')}
+    if route == 'sms_archive':
+        data['full_archive'] = '1'
+    response = client.post('/process-sms', data=data, content_type='multipart/form-data')
+    return wait_for_job(client, response.get_data(as_text=True))
+
+
+def child(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        app, ClassificationCache, gemini, gmail = load_app(args, workdir)
+        from fake_google import synthetic_sms_backup
+        sms_backup = synthetic_sms_backup(args.size)
+
+        latencies = []
+        messages = 0
+        started = time.perf_counter()
+
+        def one_run(number):
+            # Cold runs: a new user (no stored results, no checkpoints) and an empty cache
+            user = 'bench@example.com' if args.warm else f'bench{number}@example.com'
+            client = client_for(app, user)
+            start = time.perf_counter()
+            count = run_route(args.route, client, sms_backup)
+            return time.perf_counter() - start, count
+
+        for round_number in range(args.runs):
+            if not args.warm:
+                app.classification_cache = ClassificationCache(
+                    app.CACHE_PATH, namespace=f"bench{round_number}"
+                )
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                numbers = range(round_number * args.concurrency, (round_number + 1) * args.concurrency)
+                for seconds, count in pool.map(one_run, numbers):
+                    latencies.append(seconds)
+                    messages += count
+
+        wall = time.perf_counter() - started
+        print(json.dumps({
+            'latencies': latencies,
+            'messages': messages,
+            'wall': wall,
+            'gemini_calls': gemini.calls,
+            'gemini_429': gemini.rate_limited,
+            'gemini_errors': gemini.errors,
+            'gmail_round_trips': gmail.round_trips,
+            # ru_maxrss is in KB on Linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }))
+
+
+# --- PARENT PROCESS ---
+
+def measure(args, route, size):
+    """Runs one route at one size in a child process and returns its report."""
+    command = [sys.executable, __file__, '--child', route, '--size', str(size)]
+    for name in CHILD_OPTIONS:
+        value = getattr(args, name)
+        if isinstance(value, bool):
+            if value:
+                command.append('--' + name.replace('_', '-'))
+        else:
+            command += ['--' + name.replace('_', '-'), str(value)]
+    output = subprocess.run(command, capture_output=True, text=True, cwd=ROOT)
+    if output.returncode != 0:
+        raise RuntimeError(f"{route} size {size} failed:\n{output.stderr[-2000:]}")
+    # The app prints its own progress lines; the report is the last line
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+CHILD_OPTIONS = ['runs', 'concurrency', 'warm', 'rpm', 'tpm', 'gemini_latency', 'gemini_jitter', 'error_rate',
+                 'rate_limit_rate', 'retry_hint', 'gmail_latency', 'gmail_error_rate']
+
+
+def main(args):
+    print(f"{'route':>12} {'size':>6} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'msgs/s':>8} "
+          f"{'gemini':>7} {'429s':>5} {'gmail':>6} {'peak MB':>8}")
+    for route in args.routes:
+        for size in args.sizes:
+            report = measure(args, route, size)
+            latencies = report['latencies']
+            print(f"{route:>12} {size:>6} {percentile(latencies, 50):>7.2f} {percentile(latencies, 95):>7.2f} "
+                  f"{percentile(latencies, 99):>7.2f} {report['messages'] / report['wall']:>8.1f} "
+                  f"{report['gemini_calls']:>7} {report['gemini_429']:>5} {report['gmail_round_trips']:>6} "
+                  f"{report['peak_rss_kb'] / 1024:>8.1f}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--child', metavar='ROUTE', choices=ROUTES, help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 200], help="inbox size / SMS count")
+    parser.add_argument('--runs', type=int, default=5, help="rounds per route and size")
+    parser.add_argument('--concurrency', type=int, default=1, help="requests at the same time in each round")
+    parser.add_argument('--warm', action='store_true', help="keep the same user and cache across runs")
+    parser.add_argument('--rpm', type=float, default=100000, help="rate limiter requests per minute")
+    parser.add_argument('--tpm', type=float, default=100000000, help="rate limiter tokens per minute")
+    parser.add_argument('--gemini-latency', type=float, default=0.5, help="seconds per Gemini call")
+    parser.add_argument('--gemini-jitter', type=float, default=0.1)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of Gemini calls failing with 503")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="fraction of Gemini calls failing with 429")
+    parser.add_argument('--retry-hint', type=float, default=0.5, help="the 'retry in N s' of a fake 429")
+    parser.add_argument('--gmail-latency', type=float, default=0.1, help="seconds per Gmail round trip")
+    parser.add_argument('--gmail-error-rate', type=float, default=0.0, help="fraction of emails Gmail fails to return")
+    args = parser.parse_args()
+    if args.child:
+        args.route = args.child
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.child:
+        child(args)
+    else:
+        main(args)
@@ -0,0 +1,99 @@
+"""Peak memory of reading an SMS backup: ET.parse() vs the streaming iter_sms().
+
+Writes synthetic "SMS Backup & Restore" files of growing size (SMS plus MMS
+with base64 attachments) and reads each one in a fresh process, so the
+peak RSS of every run is measured on its own.
+
+    python benchmarks/bench_sms_reader.py --sizes 10 50 200
+"""
+import argparse
+import base64
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# One fake 32KB attachment, reused for every MMS part
+ATTACHMENT = base64.b64encode(os.urandom(24 * 1024)).decode()
+
+
+def write_backup(path, target_mb):
+    """Writes a backup of roughly target_mb megabytes and returns the SMS count."""
+    sms_count = 0
+    with open(path, 'w') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n<smses>\n")
+        i = 0
+        while f.tell() < target_mb * 1024 * 1024:
+            if i % 10 == 0:
+                f.write(f'<mms date="{i}" address="+15550000"><parts>'
+                        f'<part ct="image/jpeg" data="{ATTACHMENT}" /></parts></mms>\n')
+            else:
+                f.write(f'<sms address="+1555{i:07d}" body="Your code is {i}. Do not share it." date="{i}" />\n')
+                sms_count += 1
+            i += 1
+        f.write("</smses>\n")
+    return sms_count
+
+
+def read_with_et_parse(path, limit):
+    import xml.etree.ElementTree as ET
+    count = 0
+    for _ in ET.parse(path).getroot().iter('sms'):
+        count += 1
+        if limit and count >= limit:
+            break
+    return count
+
+
+def read_with_iter_sms(path, limit):
+    from sms_reader import iter_sms
+    return sum(1 for _ in iter_sms(path, limit=limit))
+
+
+READERS = {'et_parse': read_with_et_parse, 'iter_sms': read_with_iter_sms}
+
+
+def measure(reader, path, limit):
+    """Runs one reader in a child process; returns (messages, seconds, peak RSS in MB)."""
+    output = subprocess.check_output(
+        [sys.executable, __file__, '--child', reader, path, str(limit or 0)], text=True
+    )
+    count, seconds, peak_kb = output.split()
+    return int(count), float(seconds), int(peak_kb) / 1024
+
+
+def child(reader, path, limit):
+    start = time.perf_counter()
+    count = READERS[reader](path, int(limit) or None)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux
+    print(count, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200], help="file sizes in MB")
+    parser.add_argument('--limit', type=int, default=0, help="stop after this many SMS (0 = read everything)")
+    args = parser.parse_args()
+
+    print(f"{'size MB':>8} {'reader':>9} {'sms read':>9} {'seconds':>8} {'peak RSS MB':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            path = os.path.join(tmp, f'backup_{size}mb.xml')
+            write_backup(path, size)
+            for reader in READERS:
+                count, seconds, peak_mb = measure(reader, path, args.limit)
+                print(f"{size:>8} {reader:>9} {count:>9} {seconds:>8.2f} {peak_mb:>12.1f}")
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        child(*sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,274 @@
+"""Local stand-ins for Gemini and the Gmail API, for benchmarks.
+
+Both fakes answer in the same shape as the real services, after a
+configurable delay, and can be told to fail a fraction of their calls:
+
+    FakeGemini(latency=0.8, jitter=0.3, error_rate=0.02, rate_limit_rate=0.05)
+    FakeGmail(inbox_size=500, latency=0.15, error_rate=0.01)
+
+The errors have the same class names as the google-api-core ones
+(ResourceExhausted, ServiceUnavailable), so rate_limiter.py retries them
+exactly like the real thing.
+"""
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+
+# --- FAKE ERRORS ---
+
+class ResourceExhausted(Exception):
+    """A 429 from Gemini."""
+    code = 429
+
+
+class ServiceUnavailable(Exception):
+    """A 503 from Gemini."""
+    code = 503
+
+
+class FakeHttpError(Exception):
+    """What the Gmail batch callback gets for a message it could not fetch."""
+
+
+# --- SYNTHETIC MESSAGES ---
+#
+# A mix of the messages a real inbox / phone has, so the local rules
+# (rules.py) absorb about as much as they would in real life.
+
+SENDERS = ['Alice <alice@example.com>', 'Bob <bob@example.com>', 'HDFC Bank <alerts@hdfcbank.net>',
+           'Amazon <store-news@amazon.in>', 'GitHub <noreply@github.com>', 'Mom <mom@example.com>']
+SNIPPETS = [
+    "Are we still on for dinner on {n}? Let me know if the time works for you.",
+    "Your OTP is {n}. Do not share it with anyone.",
+    "Rs. {n} has been debited from your account ending 1234.",
+    "Flat {n}% off on everything this weekend only, shop now!",
+    "Can you review the pull request #{n} before the release tomorrow?",
+    "Meeting notes from today's sync: we agreed to ship version {n} next week.",
+]
+# The SNIPPETS that are people talking (the others are alerts and promotions)
+CONVERSATION_KINDS = {0, 4, 5}
+SMS_SENDERS = ['+15550001111', '+15550002222', 'AD-HDFCBK', 'VM-AMAZON', 'JD-OFFERS', '+15550003333']
+
+
+def synthetic_inbox(size, seed=0):
+    """Returns `size` fake emails, newest first, as Gmail metadata responses."""
+    rng = random.Random(seed)
+    now_ms = 1700000000000
+    messages = []
+    while len(messages) < size:
+        kind = rng.randrange(len(SNIPPETS))
+        # Alerts and promotions come alone; people write back and forth
+        length = rng.randint(1, 3) if kind in CONVERSATION_KINDS else 1
+        thread_id = f't{size - len(messages):08d}'
+        for _ in range(min(length, size - len(messages))):
+            i = len(messages)
+            messages.append({
+                'id': f'm{size - i:08d}',
+                'threadId': thread_id,
+                'internalDate': str(now_ms - i * 60000),
+                'snippet': SNIPPETS[kind].format(n=rng.randint(10, 99999)),
+                'payload': {'headers': [
+                    {'name': 'From', 'value': SENDERS[kind]},
+                    {'name': 'Subject', 'value': f'Message {i}'},
+                ]},
+            })
+    return messages
+
+
+def synthetic_sms_backup(count, seed=0, mms_every=0):
+    """Returns an "SMS Backup & Restore" XML file with `count` messages, as bytes.
+
+    With mms_every=N, every Nth record is an MMS (which the app skips).
+    """
+    rng = random.Random(seed)
+    parts = ["<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n<smses count=\"%d\">\n" % count]
+    for i in range(count):
+        if mms_every and i % mms_every == 0:
+            parts.append(f'<mms date="{1700000000000 + i}" address="+15550000000"><parts>'
+                         f'<part ct="text/plain" text="picture {i}" /></parts></mms>\n')
+        kind = rng.randrange(len(SNIPPETS))
+        body = SNIPPETS[kind].format(n=rng.randint(10, 99999)).replace('"', '&quot;').replace("'", '&apos;')
+        parts.append(f'<sms address="{SMS_SENDERS[kind]}" body="{body}" date="{1700000000000 + i * 1000}" type="1" />\n')
+    parts.append("</smses>\n")
+    return "".join(parts).encode()
+
+
+# --- FAKE GEMINI ---
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens, output_tokens):
+        self.text = text
+        self.usage_metadata = type('Usage', (), {
+            'prompt_token_count': prompt_tokens,
+            'candidates_token_count': output_tokens,
+        })()
+
+
+class FakeGemini:
+    """Answers classification prompts like Gemini would, after `latency` seconds.
+
+    `latency` is the base delay of one call; each call adds up to
+    `per_item` seconds for every message in the prompt, plus random
+    +-`jitter`. `error_rate` of the calls fail with a 503 and
+    `rate_limit_rate` with a 429 (with a "retry in N s" hint).
+    """
+
+    def __init__(self, latency=0.5, jitter=0.1, per_item=0.02, error_rate=0.0, rate_limit_rate=0.0,
+                 retry_hint=0.5, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.per_item = per_item
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_hint = retry_hint
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def _plan(self, prompt):
+        """Returns (delay, exception or None, response) for one call."""
+        ids = re.findall(r'^ID: (\S+)$', prompt, re.MULTILINE)
+        with self._lock:
+            self.calls += 1
+            roll = self._random.random()
+            delay = max(0.0, self.latency + self.per_item * len(ids) + self._random.uniform(-self.jitter, self.jitter))
+            error = None
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                error = ResourceExhausted(f"429 Quota exceeded. Please retry in {self.retry_hint}s.")
+            elif roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                error = ServiceUnavailable("503 The model is overloaded.")
+        return delay, error, self._answer(prompt, ids)
+
+    def _answer(self, prompt, ids):
+        if 'Classify the email' in prompt or 'Classify each email' in prompt:
+            priorities = ['Alert', 'High', 'Medium', 'Low']
+        else:
+            priorities = ['Urgent', 'Important', 'Other']
+
+        def result(key):
+            # The same message always gets the same answer
+            return {
+                'priority': priorities[sum(map(ord, key)) % len(priorities)],
+                'from': 'Sender',
+                'summary': f'Summary of message {key}.',
+            }
+
+        if ids:
+            text = json.dumps([dict(result(i), id=i) for i in ids])
+        else:
+            text = json.dumps(result(prompt[-40:]))
+        return FakeResponse(text, max(1, len(prompt) // 4), max(1, len(text) // 4))
+
+    def generate_content(self, prompt, **kwargs):
+        delay, error, response = self._plan(prompt)
+        time.sleep(delay)
+        if error:
+            raise error
+        return response
+
+    async def generate_content_async(self, prompt, **kwargs):
+        delay, error, response = self._plan(prompt)
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return response
+
+
+# --- FAKE GMAIL ---
+
+class _Request:
+    def __init__(self, service, fn):
+        self.service = service
+        self.fn = fn
+
+    def execute(self):
+        self.service._round_trip()
+        return self.fn()
+
+
+class _Batch:
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id, request))
+
+    def execute(self):
+        # The whole batch is ONE round trip
+        self.service._round_trip()
+        for request_id, request in self.requests:
+            if self.service._fails():
+                self.callback(request_id, None, FakeHttpError(f"<HttpError 500 fetching {request_id}>"))
+            else:
+                self.callback(request_id, request.fn(), None)
+
+
+class FakeGmail:
+    """Enough of the Gmail v1 API for app.py, with `latency` seconds per round trip."""
+
+    def __init__(self, inbox_size=100, latency=0.1, error_rate=0.0, email='bench@example.com', seed=0):
+        self.inbox = synthetic_inbox(inbox_size, seed=seed)
+        self.by_id = {m['id']: m for m in self.inbox}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.email = email
+        self.history_id = 1000
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.round_trips = 0
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        time.sleep(self.latency)
+
+    def _fails(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    # service.users().messages().list(...) etc. all land on this object
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def getProfile(self, userId):
+        return _Request(self, lambda: {'emailAddress': self.email, 'historyId': str(self.history_id)})
+
+    def list(self, userId, labelIds=None, maxResults=100, pageToken=None, startHistoryId=None, q=None, **kwargs):
+        if startHistoryId is not None:
+            # history().list(): nothing changed since last time
+            return _Request(self, lambda: {'history': [], 'historyId': str(self.history_id)})
+
+        # The only search the app uses: "after:<unix seconds>"
+        inbox = self.inbox
+        if q:
+            after = int(q.split(':', 1)[1])
+            inbox = [m for m in inbox if int(m['internalDate']) // 1000 > after]
+
+        start = int(pageToken or 0)
+        page = inbox[start:start + maxResults]
+        response = {'messages': [{'id': m['id'], 'threadId': m['threadId']} for m in page]}
+        if start + maxResults < len(inbox):
+            response['nextPageToken'] = str(start + maxResults)
+        return _Request(self, lambda: response)
+
+    def get(self, userId, id, **kwargs):
+        return _Request(self, lambda: self.by_id[id])
+
+    def new_batch_http_request(self, callback):
+        return _Batch(self, callback)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import sqlite3
+import time
+
+# --- CLASSIFICATION CACHE ---
+#
+# Gemini always gives (roughly) the same answer for the same message, so
+# there is no point asking twice. We save every parsed answer in a small
+# SQLite file, keyed by a hash of:
+#   - the prompt version and model name (changing either starts fresh)
+#   - the message itself (Gmail ID + snippet, or SMS address + body)
+#
+# Old entries are dropped after a TTL, and if the cache grows past
+# max_entries the least recently used ones are dropped first.
+
+DEFAULT_TTL = 30 * 24 * 3600  # 30 days
+DEFAULT_MAX_ENTRIES = 50000
+
+
+def content_key(namespace, kind, item):
+    """Hashes everything that can change the model's answer for one item."""
+    if kind == 'email':
+        content = [item['id'], item['text']]
+    else:
+        content = [item['sender'], item['text']]
+    raw = json.dumps([namespace, kind] + content)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ClassificationCache:
+    """SQLite-backed {content hash: parsed result} store with LRU/TTL eviction."""
+
+    def __init__(self, path, namespace, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        self.path = path
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS classifications (
+                    key TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_classifications_last_used ON classifications (last_used)")
+
+    def _connect(self):
+        # A fresh connection per call keeps this safe to use from any thread
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get_many(self, kind, items):
+        """Returns {item id: cached result} for every item we already know."""
+        keys = {content_key(self.namespace, kind, item): item['id'] for item in items}
+        if not keys:
+            return {}
+
+        now = time.time()
+        found = {}
+        with self._connect() as conn:
+            placeholders = ",".join("?" * len(keys))
+            rows = conn.execute(
+                f"SELECT key, result FROM classifications WHERE key IN ({placeholders}) AND created_at > ?",
+                list(keys) + [now - self.ttl],
+            ).fetchall()
+            for key, result in rows:
+                found[keys[key]] = json.loads(result)
+
+            hit_keys = [(now, key) for key, _ in rows]
+            conn.executemany("UPDATE classifications SET last_used = ? WHERE key = ?", hit_keys)
+        return found
+
+    def put_many(self, kind, items, results):
+        """Saves the results for these items (errors are never cached)."""
+        now = time.time()
+        rows = []
+        for item in items:
+            result = results.get(item['id'])
+            if not result or 'error' in result:
+                continue
+            rows.append((content_key(self.namespace, kind, item), json.dumps(result), now, now))
+
+        if not rows:
+            return
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO classifications VALUES (?, ?, ?, ?)", rows)
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM classifications WHERE created_at <= ?", (now - self.ttl,))
+        conn.execute("""
+            DELETE FROM classifications WHERE key IN (
+                SELECT key FROM classifications ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (self.max_entries,))
@@ -0,0 +1,48 @@
+import json
+import sqlite3
+import time
+
+# --- ARCHIVE CHECKPOINTS ---
+#
+# Working through a whole mailbox or SMS archive can take a long time, and
+# the server may restart half way. After every batch we save a small JSON
+# "checkpoint" per user (which Gmail page we were on, how far into the XML
+# file we got, the newest message we already handled...), so the next run
+# can pick up where the last one stopped and skip what it already did.
+
+
+class CheckpointStore:
+    """Saves one JSON checkpoint per (user, name) in SQLite."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    user TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user, name)
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, user, name):
+        """Returns the saved checkpoint, or {} if there is none."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM checkpoints WHERE user = ? AND name = ?", (user, name)
+            ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def put(self, user, name, data):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+                (user, name, json.dumps(data), time.time()),
+            )
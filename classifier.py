@@ -0,0 +1,377 @@
+import asyncio
+import json
+import queue
+import re
+import threading
+
+from metrics import metrics
+from prompts import build_batch_prompt, build_single_prompt, estimate_tokens
+
+# --- GEMINI CLASSIFICATION HELPERS ---
+#
+# Both the email page and the SMS page ask Gemini the same kind of question:
+# "here is a message, give me a priority, a sender and a one-line summary".
+# Instead of asking once per message, we pack a whole batch into ONE prompt
+# and get a JSON array back. Anything the model forgets or mangles is
+# re-asked on its own with the single-message prompt. The prompts
+# themselves are built in prompts.py.
+
+# How many messages go into one batch prompt
+BATCH_SIZE = 20
+
+# The async engine: how many Gemini calls may be in flight at once, and how
+# long one call may take before it is cancelled
+MAX_IN_FLIGHT = 4
+CALL_TIMEOUT = 60
+
+# Bump this whenever the prompts (see prompts.py) change, so cached
+# answers from the old prompts are not reused (see cache.py)
+PROMPT_VERSION = 2
+
+# The only priorities each kind of message may get
+PRIORITIES = {
+    'email': ['Alert', 'High', 'Medium', 'Low'],
+    'sms': ['Urgent', 'Important', 'Other'],
+}
+
+
+# --- STRUCTURED OUTPUT ---
+#
+# We ask Gemini for JSON mode with a response schema, so the answer is
+# (almost always) valid JSON with a priority from our list. Just in case,
+# the parser below still copes with code fences, stray prose around the
+# JSON and trailing commas, and counts how often it had to.
+
+def response_schema(kind, batch=False):
+    """The JSON schema of one answer (or of a batch answer)."""
+    properties = {
+        'priority': {'type': 'STRING', 'enum': PRIORITIES[kind]},
+        'from': {'type': 'STRING'},
+        'summary': {'type': 'STRING'},
+    }
+    required = ['priority', 'from', 'summary']
+    if batch:
+        properties = dict(id={'type': 'STRING'}, **properties)
+        required = ['id'] + required
+    schema = {'type': 'OBJECT', 'properties': properties, 'required': required}
+    return {'type': 'ARRAY', 'items': schema} if batch else schema
+
+
+def generation_config(kind, batch=False):
+    return {'response_mime_type': 'application/json', 'response_schema': response_schema(kind, batch)}
+
+
+class ParseStats:
+    """Counts model answers, and how many needed repair or could not be used at all."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'responses': 0, 'repaired': 0, 'failed': 0, 'invalid_items': 0}
+
+    def add(self, name, count=1):
+        with self._lock:
+            self.counts[name] += count
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        counts['failure_rate'] = counts['failed'] / counts['responses'] if counts['responses'] else 0.0
+        return counts
+
+
+parse_stats = ParseStats()
+
+
+class TokenUsage:
+    """Input/output token totals per kind of call, e.g. ('sms', 'batch').
+
+    Uses the counts Gemini reports in usage_metadata, or our local
+    estimate when a response doesn't have them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = {}
+
+    def record(self, kind, mode, prompt, response):
+        usage = getattr(response, 'usage_metadata', None)
+        input_tokens = getattr(usage, 'prompt_token_count', None) or estimate_tokens(prompt)
+        output_tokens = getattr(usage, 'candidates_token_count', None) or estimate_tokens(response.text)
+        with self._lock:
+            totals = self.calls.setdefault(f"{kind}_{mode}", {'calls': 0, 'input_tokens': 0, 'output_tokens': 0})
+            totals['calls'] += 1
+            totals['input_tokens'] += input_tokens
+            totals['output_tokens'] += output_tokens
+
+    def snapshot(self):
+        with self._lock:
+            return {name: dict(totals) for name, totals in self.calls.items()}
+
+
+token_usage = TokenUsage()
+
+
+def clean_json(text):
+    """Removes the ```json fences Gemini likes to wrap its answers in."""
+    return text.strip().replace("```json", "").replace("```", "")
+
+
+def extract_json(text):
+    """Parses the model's answer, repairing the usual mistakes if needed."""
+    parse_stats.add('responses')
+    text = clean_json(text)
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+
+    # Skip any prose before the JSON, drop trailing commas, and read the
+    # first complete JSON value (ignoring anything after it)
+    starts = [i for i in (text.find('['), text.find('{')) if i != -1]
+    if starts:
+        candidate = re.sub(r',\s*([}\]])', r'\1', text[min(starts):])
+        try:
+            data, _ = json.JSONDecoder().raw_decode(candidate)
+            parse_stats.add('repaired')
+            return data
+        except ValueError:
+            pass
+
+    parse_stats.add('failed')
+    raise ValueError(f"Could not find JSON in the answer: {text[:200]}")
+
+
+def validate_result(kind, entry):
+    """Returns a clean {'priority', 'from', 'summary'} dict, or None if unusable."""
+    if not isinstance(entry, dict):
+        return None
+    allowed = {p.lower(): p for p in PRIORITIES[kind]}
+    priority = allowed.get(str(entry.get('priority', '')).strip().lower())
+    if priority is None:
+        return None
+    result = {'priority': priority, 'summary': str(entry.get('summary') or 'Could not summarize.')}
+    if entry.get('from'):
+        result['from'] = str(entry['from'])
+    return result
+
+
+def parse_batch_response(kind, text):
+    """Turns the model's JSON array into a dict of {id: result}.
+
+    Entries without an ID or a valid priority are dropped, so the caller
+    will notice they are missing and re-ask them.
+    """
+    data = extract_json(text)
+    if isinstance(data, dict):
+        data = [data]
+
+    results = {}
+    for entry in data:
+        result = validate_result(kind, entry)
+        if result is None or 'id' not in entry:
+            parse_stats.add('invalid_items')
+            continue
+        results[str(entry['id'])] = result
+    return results
+
+
+def answer_locally(kind, items, cache=None, rules=None, local_model=None):
+    """Answers what we can without Gemini: local rules first, then the cache,
+    then whatever the local model (see local_model.py) is confident about.
+
+    Returns (results, items still needing the model).
+    """
+    results = {}
+
+    if rules is not None:
+        for item in items:
+            # A rule matching one line of a conversation says nothing about
+            # the rest of it (and would match its earlier summary next time)
+            if item.get('conversation'):
+                continue
+            decided = rules.classify(kind, item)
+            if decided is not None:
+                results[item['id']] = decided
+        items = [item for item in items if item['id'] not in results]
+
+    if cache is not None:
+        with metrics.span('cache_lookup'):
+            cached = cache.get_many(kind, items)
+        metrics.inc('ai_inbox_cache_lookups_total', len(cached), kind=kind, result='hit')
+        metrics.inc('ai_inbox_cache_lookups_total', len(items) - len(cached), kind=kind, result='miss')
+        results.update(cached)
+        items = [item for item in items if item['id'] not in results]
+
+    if local_model is not None:
+        confident = local_model.confident(kind, items)
+        metrics.inc('ai_inbox_local_model_answers_total', len(confident), kind=kind, reason='confident')
+        results.update(confident)
+        items = [item for item in items if item['id'] not in results]
+
+    return results, items
+
+
+def learn_and_fill(local_model, kind, items, results):
+    """Teaches the local model Gemini's answers, then gives failed items its guess instead of an error."""
+    if local_model is None:
+        return results
+    local_model.learn(kind, items, results)
+    for item in items:
+        result = results.get(item['id'])
+        if result is not None and 'error' in result:
+            guess = local_model.fallback(kind, item, result['error'])
+            if guess is not None:
+                metrics.inc('ai_inbox_local_model_answers_total', kind=kind, reason='fallback')
+                results[item['id']] = guess
+    return results
+
+
+def group_duplicates(dedup, items):
+    """Keeps one item per near-duplicate cluster (see dedup.py).
+
+    Returns (items to classify, {representative id: duplicates}, {id: item}).
+    """
+    if dedup is None:
+        return items, {}, {}
+    representatives, members = dedup.group(items)
+    return representatives, members, {item['id']: item for item in representatives}
+
+
+def parse_single_response(kind, text):
+    result = validate_result(kind, extract_json(text))
+    if result is None:
+        parse_stats.add('invalid_items')
+        raise ValueError(f"Expected a JSON object with a valid priority, got: {text[:200]}")
+    return result
+
+
+# --- ASYNC CLASSIFICATION ENGINE ---
+#
+# Every batch is sent at once (up to MAX_IN_FLIGHT at a time) with
+# generate_content_async, so a page takes about as long as its slowest
+# call instead of the sum of all of them.
+#
+# It owns one event loop running in a background thread. Gemini's async
+# client belongs to the loop it was first used on, so every call must go
+# through the same loop; Flask routes and background jobs just iterate
+# over engine.iter_classify(...) from their own threads.
+
+
+class AsyncClassifier:
+    """Runs batch classification concurrently on a shared asyncio loop."""
+
+    def __init__(self, model, max_in_flight=MAX_IN_FLIGHT, call_timeout=CALL_TIMEOUT):
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.call_timeout = call_timeout
+        self._semaphore = None
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='gemini-async', daemon=True).start()
+
+    async def _generate(self, kind, mode, prompt, config=None):
+        # Created lazily so it belongs to our loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self._semaphore:
+            # wait_for cancels the call if it takes too long (this includes
+            # any wait for the rate limiter, see RateLimitedModel)
+            with metrics.span('gemini_generate'):
+                response = await asyncio.wait_for(
+                    self.model.generate_content_async(prompt, generation_config=config), self.call_timeout
+                )
+        token_usage.record(kind, mode, prompt, response)
+        return response.text
+
+    async def _classify_one(self, kind, item):
+        try:
+            with metrics.span('prompt_build'):
+                prompt = build_single_prompt(kind, item)
+            text = await self._generate(kind, 'single', prompt, generation_config(kind))
+            with metrics.span('parse'):
+                return parse_single_response(kind, text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.inc('ai_inbox_gemini_failures_total', kind=kind, mode='single')
+            return {'error': str(e) or type(e).__name__}
+
+    async def _classify_chunk(self, kind, chunk, cache):
+        try:
+            with metrics.span('prompt_build'):
+                prompt = build_batch_prompt(kind, chunk)
+            text = await self._generate(kind, 'batch', prompt, generation_config(kind, batch=True))
+            with metrics.span('parse'):
+                answers = parse_batch_response(kind, text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Batch classification failed, asking one by one: {str(e) or type(e).__name__}")
+            metrics.inc('ai_inbox_gemini_failures_total', kind=kind, mode='batch')
+            answers = {}
+
+        results = {}
+        retry = []
+        for number, item in enumerate(chunk, start=1):
+            answer = answers.get(str(number))
+            if answer is not None:
+                results[item['id']] = answer
+            else:
+                retry.append(item)
+
+        # Missing or malformed in the batch answer: re-ask those alone, all at once
+        singles = await asyncio.gather(*(self._classify_one(kind, item) for item in retry))
+        for item, answer in zip(retry, singles):
+            results[item['id']] = answer
+
+        if cache is not None:
+            cache.put_many(kind, chunk, results)
+        return results
+
+    def iter_classify(self, kind, items, batch_size=BATCH_SIZE, cache=None, rules=None, dedup=None,
+                      local_model=None):
+        """Blocking generator: yields a {id: result} dict for every batch as soon as it is done.
+
+        Each item is a dict with 'id', 'sender' and 'text'. A result is the
+        parsed answer of the model, or {'error': "..."} if even the single
+        re-ask failed.
+
+        Local answers come first: obvious messages decided by the `rules`,
+        items the `cache` already knows, and what the `local_model` is sure
+        about. If a Deduplicator is given, only one item of each cluster of
+        near-duplicates is sent, and its answer comes in the same batch for
+        the others. The local model learns from every answer and stands in
+        for Gemini when a call fails. If the caller stops early (e.g. the
+        browser closed the page), unfinished calls are cancelled.
+        """
+        results, items = answer_locally(kind, items, cache, rules, local_model)
+        if results:
+            yield results
+
+        items, members, items_by_id = group_duplicates(dedup, items)
+
+        chunks = [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+        if not chunks:
+            return
+
+        finished = queue.Queue()
+
+        async def run_chunk(chunk):
+            try:
+                answers = await self._classify_chunk(kind, chunk, cache)
+            except Exception as e:
+                answers = {item['id']: {'error': str(e) or type(e).__name__} for item in chunk}
+            finished.put((chunk, answers))
+
+        async def run_all():
+            await asyncio.gather(*(run_chunk(chunk) for chunk in chunks))
+
+        future = asyncio.run_coroutine_threadsafe(run_all(), self.loop)
+        try:
+            for _ in chunks:
+                # The calls run on the engine's loop; this is the time the caller spends waiting for them
+                with metrics.span('classify_wait'):
+                    chunk, results = finished.get()
+                learn_and_fill(local_model, kind, chunk, results)
+                yield dedup.spread(results, members, items_by_id) if members else results
+        finally:
+            future.cancel()
@@ -0,0 +1,167 @@
+import hashlib
+import random
+import re
+import threading
+
+# --- NEAR-DUPLICATE CLUSTERING ---
+#
+# Inboxes and SMS backups are full of templated messages: "Your OTP is
+# 482913", "Rs. 500 debited from A/c XX1234", shipping updates... They
+# only differ in digits or names, and Gemini would sort them all the same
+# way. So before asking the model we group them:
+#
+#   1. Only messages from the same sender can be grouped.
+#   2. Bodies are normalized: lower case, URLs / email addresses masked,
+#      and every word containing a digit becomes "#". Most templated
+#      messages are now identical.
+#   3. The rest are compared with MinHash signatures of their word pairs.
+#      An LSH index (the signature cut into bands) finds the candidates,
+#      and a message joins a cluster when its estimated Jaccard similarity
+#      to the cluster's first message is at least `threshold`.
+#
+# Only the first message of each cluster (its representative) is sent to
+# Gemini; the others get the same priority (see Deduplicator.spread).
+
+DEFAULT_THRESHOLD = 0.8
+
+# 32 hash functions in 8 bands of 4: messages with about 60% similarity or
+# more usually share a band, and the threshold check does the rest
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240501)  # Fixed, so signatures are the same in every process
+PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+_URL = re.compile(r'(https?://|www\.)\S+')
+_EMAIL = re.compile(r'\S+@\S+\.\w+')
+_HAS_DIGIT = re.compile(r'\S*\d\S*')
+_PUNCTUATION = re.compile(r'[^\w#<> ]+')
+_WHITESPACE = re.compile(r'\s+')
+_SHORT_CODE_PREFIX = re.compile(r'^[A-Z]{2}-')
+_ADDRESS = re.compile(r'<([^>]+)>')
+
+
+def normalize(text):
+    """Masks the parts of a message that change between copies of the same template."""
+    text = (text or '').lower()
+    text = _URL.sub(' <url> ', text)
+    text = _EMAIL.sub(' <email> ', text)
+    text = _HAS_DIGIT.sub(' # ', text)
+    text = _PUNCTUATION.sub(' ', text)
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+def normalize_sender(sender):
+    """'Bank <alerts@bank.com>' -> 'alerts@bank.com'; 'AD-HDFCBK' -> 'HDFCBK'."""
+    sender = (sender or '').strip()
+    match = _ADDRESS.search(sender)
+    if match:
+        return match.group(1).lower()
+    return _SHORT_CODE_PREFIX.sub('', sender).lower()
+
+
+def _hash(feature):
+    return int.from_bytes(hashlib.blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def minhash(text):
+    """MinHash signature of a normalized text's word pairs (or single word)."""
+    words = text.split()
+    features = {' '.join(words[i:i + 2]) for i in range(len(words) - 1)} or {text}
+    hashes = [_hash(feature) for feature in features]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in PERMUTATIONS)
+
+
+def similarity(signature_a, signature_b):
+    """Estimated Jaccard similarity of two signatures."""
+    return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / NUM_PERM
+
+
+def short_summary(text):
+    return text[:120] + ('...' if len(text) > 120 else '')
+
+
+class Deduplicator:
+    """Groups near-duplicate messages and shares one answer across each group."""
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.seen = 0
+        self.duplicates = 0
+
+    def group(self, items):
+        """Returns (representatives, {representative id: [duplicate items]})."""
+        representatives = []
+        members = {}
+        exact = {}      # (sender, normalized text) -> representative
+        by_id = {}      # representative id -> representative
+        signatures = {} # representative id -> signature
+        index = {}      # (sender, band number, band) -> [representative ids]
+
+        for item in items:
+            if item.get('conversation'):
+                # Conversations are never copies of each other (and their
+                # text starts with a stored summary, which must not match)
+                representatives.append(item)
+                continue
+
+            sender = normalize_sender(item['sender'])
+            text = normalize(item['text'])
+
+            leader = exact.get((sender, text))
+            if leader is None and self.threshold < 1:
+                signature = minhash(text)
+                bands = [(sender, band, signature[band * ROWS:(band + 1) * ROWS]) for band in range(BANDS)]
+                candidates = {rep_id for key in bands for rep_id in index.get(key, [])}
+                best = max(candidates, key=lambda rep_id: similarity(signature, signatures[rep_id]), default=None)
+                if best is not None and similarity(signature, signatures[best]) >= self.threshold:
+                    leader = by_id[best]
+                else:
+                    signatures[item['id']] = signature
+                    for key in bands:
+                        index.setdefault(key, []).append(item['id'])
+
+            if leader is None:
+                representatives.append(item)
+                exact[(sender, text)] = by_id[item['id']] = item
+            else:
+                members.setdefault(leader['id'], []).append(item)
+
+        with self._lock:
+            self.seen += len(items)
+            self.duplicates += len(items) - len(representatives)
+        return representatives, members
+
+    def spread(self, results, members, items_by_id):
+        """Adds a result for every duplicate whose representative is in `results`.
+
+        A duplicate gets its representative's priority and sender name. The
+        summary is only shared by exact copies; the others use their own
+        text, since it is their digits and names that differ.
+        """
+        shared = dict(results)
+        for rep_id, result in results.items():
+            representative = items_by_id.get(rep_id)
+            for item in members.get(rep_id, []):
+                if 'error' in result:
+                    shared[item['id']] = dict(result)
+                    continue
+                shared[item['id']] = dict(
+                    result,
+                    summary=result['summary'] if representative and item['text'] == representative['text']
+                    else short_summary(item['text']),
+                    duplicate_of=rep_id,
+                )
+        return shared
+
+    def stats(self):
+        """How many messages were answered through a cluster's representative."""
+        with self._lock:
+            return {
+                'seen': self.seen,
+                'duplicates': self.duplicates,
+                'duplicate_fraction': self.duplicates / self.seen if self.seen else 0.0,
+            }
@@ -0,0 +1,177 @@
+from googleapiclient.errors import HttpError
+
+from metrics import metrics
+
+# --- GMAIL HELPERS ---
+#
+# Fetching each message with its own messages().get().execute() costs one
+# HTTPS round trip per email. Gmail lets us bundle many calls into a single
+# batch HTTP request, and with format='metadata' it only sends back the
+# headers we ask for instead of the whole email.
+
+# Gmail accepts up to 100 calls per batch, but recommends staying at 50
+# or below to avoid per-user rate limit errors.
+GMAIL_BATCH_SIZE = 50
+
+# The only headers we actually read
+METADATA_HEADERS = ['From', 'Subject']
+
+
+def get_header(msg_data, name):
+    """Returns the value of one header (like 'From') or an empty string."""
+    for header in msg_data.get('payload', {}).get('headers', []):
+        if header['name'] == name:
+            return header['value']
+    return ""
+
+
+def fetch_messages(service, message_ids, batch_size=GMAIL_BATCH_SIZE):
+    """Fetches the sender, subject and snippet of many messages at once.
+
+    Returns a dict of {message_id: info}. Each info is a dict with 'id',
+    'threadId', 'sender', 'subject', 'snippet' and 'received_at' (a Unix
+    timestamp), or {'error': "..."} if Gmail could not return that message.
+    """
+    results = {}
+
+    # The batch calls this once for every message it gets back
+    def on_message(request_id, response, exception):
+        if exception is not None:
+            metrics.inc('ai_inbox_gmail_messages_total', result='error')
+            results[request_id] = {'error': str(exception)}
+            return
+        metrics.inc('ai_inbox_gmail_messages_total', result='ok')
+        results[request_id] = {
+            'id': response['id'],
+            'threadId': response.get('threadId'),
+            'sender': get_header(response, 'From'),
+            'subject': get_header(response, 'Subject'),
+            'snippet': response.get('snippet', ''),
+            'received_at': int(response['internalDate']) / 1000 if response.get('internalDate') else None,
+        }
+
+    for start in range(0, len(message_ids), batch_size):
+        batch = service.new_batch_http_request(callback=on_message)
+        for message_id in message_ids[start:start + batch_size]:
+            batch.add(
+                service.users().messages().get(
+                    userId='me',
+                    id=message_id,
+                    format='metadata',
+                    metadataHeaders=METADATA_HEADERS,
+                ),
+                request_id=message_id,
+            )
+        with metrics.span('gmail_get'):
+            batch.execute()
+
+    return results
+
+
+# --- INCREMENTAL INBOX SYNC ---
+#
+# Instead of listing the inbox and fetching every email on each page load,
+# we keep a small snapshot of the inbox (the newest `limit` emails with
+# their sender and snippet) plus Gmail's historyId. On the next visit we
+# ask history().list() only for what changed since that historyId, and
+# fetch just the emails that are new. If the historyId is too old, Gmail
+# answers 404 and we fall back to a full resync.
+
+INBOX_LIMIT = 20
+
+
+def list_history(service, start_history_id):
+    """Returns (added_ids, removed_ids, latest_history_id) for the INBOX since start_history_id.
+
+    added_ids is newest first.
+    """
+    added = {}      # Insertion ordered, oldest change first
+    removed = set()
+    latest_history_id = start_history_id
+    page_token = None
+
+    while True:
+        with metrics.span('gmail_history'):
+            response = service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                labelId='INBOX',
+                pageToken=page_token,
+            ).execute()
+
+        for record in response.get('history', []):
+            for change in record.get('messagesAdded', []):
+                message = change['message']
+                if 'INBOX' in message.get('labelIds', []):
+                    added[message['id']] = True
+                    removed.discard(message['id'])
+            for change in record.get('labelsAdded', []):
+                if 'INBOX' in change.get('labelIds', []):
+                    added[change['message']['id']] = True
+                    removed.discard(change['message']['id'])
+            for change in record.get('messagesDeleted', []) + [
+                c for c in record.get('labelsRemoved', []) if 'INBOX' in c.get('labelIds', [])
+            ]:
+                added.pop(change['message']['id'], None)
+                removed.add(change['message']['id'])
+
+        latest_history_id = response.get('historyId', latest_history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+    return list(reversed(added)), removed, latest_history_id
+
+
+def sync_inbox(service, state, limit=INBOX_LIMIT):
+    """Brings an inbox snapshot up to date with as few API calls as possible.
+
+    `state` is what this function returned last time ({} the first time):
+    {'history_id': "...", 'messages': [info, ...]} with the newest email
+    first. Returns (new_state, errors) where errors is a list of
+    {'id': ..., 'error': "..."} for emails Gmail would not return.
+    """
+    history_id = state.get('history_id')
+    known = {}
+
+    if history_id:
+        try:
+            added, removed, history_id = list_history(service, history_id)
+            known = {m['id']: m for m in state.get('messages', []) if m['id'] not in removed}
+            # Emails Gmail would not give us last time are still worth another try
+            retry = [i for i in state.get('failed', []) if i not in removed and i not in known]
+            message_ids = [i for i in added if i not in known] + retry + list(known)
+
+            if removed and len(message_ids) < limit:
+                # Something left the inbox; one list call finds the emails that move up
+                with metrics.span('gmail_list'):
+                    result = service.users().messages().list(userId='me', labelIds=['INBOX'], maxResults=limit).execute()
+                message_ids = [msg['id'] for msg in result.get('messages', [])]
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            history_id = None # Too old: Gmail no longer has that history
+
+    if not history_id:
+        # Full resync. Read the historyId first so no change slips between the two calls.
+        with metrics.span('gmail_profile'):
+            history_id = service.users().getProfile(userId='me').execute()['historyId']
+        with metrics.span('gmail_list'):
+            result = service.users().messages().list(userId='me', labelIds=['INBOX'], maxResults=limit).execute()
+        message_ids = [msg['id'] for msg in result.get('messages', [])]
+
+    message_ids = message_ids[:limit]
+    missing = [i for i in message_ids if i not in known]
+    fetched = fetch_messages(service, missing) if missing else {}
+
+    messages = []
+    errors = []
+    for message_id in message_ids:
+        info = known.get(message_id) or fetched.get(message_id, {'error': 'Missing from the batch response.'})
+        if 'error' in info:
+            errors.append({'id': message_id, 'error': info['error']})
+        else:
+            messages.append(info)
+
+    state = {'history_id': history_id, 'messages': messages, 'failed': [e['id'] for e in errors]}
+    return state, errors
@@ -0,0 +1,197 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+import google_auth_httplib2
+import httplib2
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+
+# --- GMAIL CLIENT CACHE ---
+#
+# build('gmail', 'v1', ...) reads and parses the Gmail discovery document
+# and makes a brand new HTTP connection every time, so each page used to
+# pay for a fresh TLS handshake. Instead we keep, per user:
+#   - one Credentials object, loaded from a server-side token store
+#     (refreshed access tokens are written back to it)
+#   - ready Gmail clients with keep-alive HTTP connections
+#
+# The discovery document ships with google-api-python-client, so it is
+# parsed once per process and never downloaded.
+#
+# httplib2 connections are not thread-safe, so every thread gets its own
+# client for a user (threads are pooled, so these get reused too). The
+# least recently used users are dropped once there are more than
+# max_users of them.
+
+DEFAULT_MAX_USERS = 200
+
+# Seconds before a Gmail HTTP call gives up
+HTTP_TIMEOUT = 60
+
+_discovery_doc = None
+_discovery_lock = threading.Lock()
+
+
+def gmail_discovery_doc():
+    """The bundled Gmail v1 discovery document, parsed once."""
+    global _discovery_doc
+    with _discovery_lock:
+        if _discovery_doc is None:
+            _discovery_doc = json.loads(discovery_cache.get_static_doc('gmail', 'v1'))
+        return _discovery_doc
+
+
+def build_gmail_service(credentials):
+    """A Gmail client with its own keep-alive HTTP connection."""
+    http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+    return build_from_document(gmail_discovery_doc(), http=http)
+
+
+def credentials_to_dict(credentials):
+    """What the token store keeps of a Credentials object (JSON-friendly)."""
+    info = {
+        'token': credentials.token,
+        'refresh_token': credentials.refresh_token,
+        'token_uri': credentials.token_uri,
+        'client_id': credentials.client_id,
+        'client_secret': credentials.client_secret,
+        'scopes': list(credentials.scopes) if credentials.scopes else None,
+    }
+    if credentials.expiry:
+        info['expiry'] = credentials.expiry.isoformat()
+    return info
+
+
+class StoredCredentials(Credentials):
+    """Credentials that call on_refresh(self) every time they get a new access token."""
+
+    on_refresh = None
+
+    def refresh(self, request):
+        super().refresh(request)
+        if self.on_refresh is not None:
+            self.on_refresh(self)
+
+
+def load_credentials(info, on_refresh=None):
+    info = dict(info)
+    expiry = info.pop('expiry', None)
+    credentials = StoredCredentials(**info)
+    if expiry:
+        # google-auth wants a naive UTC datetime
+        credentials.expiry = datetime.fromisoformat(expiry).replace(tzinfo=None)
+    credentials.on_refresh = on_refresh
+    return credentials
+
+
+class TokenStore:
+    """SQLite table of each user's OAuth credentials."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS oauth_tokens (
+                    user TEXT PRIMARY KEY,
+                    credentials TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, user):
+        with self._connect() as conn:
+            row = conn.execute("SELECT credentials FROM oauth_tokens WHERE user = ?", (user,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, user, info):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO oauth_tokens VALUES (?, ?, ?)",
+                (user, json.dumps(info), time.time()),
+            )
+
+    def delete(self, user):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM oauth_tokens WHERE user = ?", (user,))
+
+    def users(self):
+        """Everyone we can still get a Gmail client for later: those with a refresh token."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT user, credentials FROM oauth_tokens").fetchall()
+        return [user for user, credentials in rows if json.loads(credentials).get('refresh_token')]
+
+
+class _UserClients:
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.local = threading.local()  # .service: this thread's client
+
+
+class GmailClients:
+    """Per-user cache of credentials and ready Gmail clients, with LRU eviction."""
+
+    def __init__(self, store, max_users=DEFAULT_MAX_USERS, factory=build_gmail_service):
+        self.store = store
+        self.max_users = max_users
+        self.factory = factory
+        self._lock = threading.Lock()
+        self._users = OrderedDict()
+        self.built = 0
+        self.reused = 0
+
+    def remember(self, user, info):
+        """Saves a user's credentials (after logging in) and drops any clients using older ones."""
+        if not info.get('refresh_token'):
+            # Google only sends a refresh token the first time someone agrees
+            # to our scopes; later logins must keep the one we already have
+            stored = self.store.get(user) or {}
+            info = dict(info, refresh_token=stored.get('refresh_token'))
+        self.store.put(user, info)
+        with self._lock:
+            self._users.pop(user, None)
+
+    def forget(self, user):
+        """Drops a user's clients and stored credentials (when they log out)."""
+        with self._lock:
+            self._users.pop(user, None)
+        self.store.delete(user)
+
+    def get(self, user):
+        """Returns a Gmail client for this user and thread, or None if we have no credentials for them."""
+        with self._lock:
+            entry = self._users.get(user)
+            if entry is not None:
+                self._users.move_to_end(user)
+
+        if entry is None:
+            info = self.store.get(user)
+            if info is None:
+                return None
+            on_refresh = lambda credentials: self.store.put(user, credentials_to_dict(credentials))
+            entry = _UserClients(load_credentials(info, on_refresh))
+            with self._lock:
+                # Another thread may have loaded this user meanwhile; keep theirs
+                entry = self._users.setdefault(user, entry)
+                self._users.move_to_end(user)
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+
+        service = getattr(entry.local, 'service', None)
+        if service is None:
+            service = entry.local.service = self.factory(entry.credentials)
+            with self._lock:
+                self.built += 1
+        else:
+            with self._lock:
+                self.reused += 1
+        return service
@@ -0,0 +1,114 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# --- BACKGROUND JOBS ---
+#
+# Classifying a big SMS backup takes far longer than a web request should.
+# So the upload just creates a Job and hands it to a small thread pool; the
+# results page then asks /jobs/<id> for progress every couple of seconds
+# and shows each batch as soon as it is done. A job belongs to the user who
+# started it, and only they can poll it.
+#
+# Jobs live in memory, so run gunicorn with ONE worker and several threads
+# (e.g. `gunicorn --workers 1 --threads 8 app:app`) so every poll reaches
+# the process that owns the job.
+
+DEFAULT_WORKERS = 4
+
+# Finished jobs are forgotten after this many seconds
+JOB_TTL = 3600
+
+
+class Job:
+    """Progress and (partial) results of one background task."""
+
+    def __init__(self, buckets, user=None):
+        self.id = uuid.uuid4().hex
+        self.user = user  # Only they may see its results
+        self.status = 'queued'
+        self.total = 0
+        self.done = 0
+        self.error = None
+        self.results = {bucket: [] for bucket in buckets}
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def start(self, total):
+        with self._lock:
+            self.status = 'running'
+            self.total = total
+
+    def add_total(self, count):
+        """For jobs that only find out how much work there is as they go."""
+        with self._lock:
+            self.total += count
+
+    def add(self, bucket, html):
+        """Adds one finished item to a results bucket."""
+        with self._lock:
+            self.results[bucket].append(html)
+            self.done += 1
+
+    def finish(self, error=None):
+        with self._lock:
+            self.status = 'error' if error else 'done'
+            self.error = error
+            self.finished_at = time.time()
+
+    def to_dict(self, offsets=None):
+        """Job status as JSON-friendly dict.
+
+        `offsets` is {bucket: how many items the caller already has}, so a
+        long-running job only sends back what is new.
+        """
+        offsets = offsets or {}
+        with self._lock:
+            return {
+                'id': self.id,
+                'status': self.status,
+                'total': self.total,
+                'done': self.done,
+                'error': self.error,
+                'results': {bucket: items[offsets.get(bucket, 0):] for bucket, items in self.results.items()},
+            }
+
+
+class JobManager:
+    """Runs jobs on a thread pool and keeps them around so they can be polled."""
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, buckets, fn, *args, user=None):
+        """Creates a job for `user` and runs fn(job, *args) in the background."""
+        job = Job(buckets, user)
+        with self._lock:
+            self._forget_old_jobs()
+            self.jobs[job.id] = job
+        self.executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, job_id, user=None):
+        """The job, or None if there is no such job or it belongs to someone else."""
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is None or job.user != user:
+            return None
+        return job
+
+    def _run(self, job, fn, args):
+        try:
+            fn(job, *args)
+            job.finish()
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            job.finish(error=str(e))
+
+    def _forget_old_jobs(self):
+        now = time.time()
+        for job_id in [j.id for j in self.jobs.values() if j.finished_at and now - j.finished_at > JOB_TTL]:
+            del self.jobs[job_id]
@@ -0,0 +1,190 @@
+import json
+import math
+import os
+import threading
+
+from dedup import normalize, normalize_sender, short_summary
+
+# --- LOCAL FALLBACK MODEL ---
+#
+# Every answer Gemini gives us is also a training example. This module
+# learns from them, as they arrive, a small classifier that needs no
+# network at all: softmax (multinomial logistic) regression over the
+# message's words, each weighted by TF-IDF, trained with one SGD step per
+# example. It is kept in a JSON file, so it loads in a few milliseconds.
+#
+# It is used two ways (see classifier.py):
+#   - routing: once it has seen `min_examples` answers for a kind of
+#     message, items it is at least `confidence` sure about are answered
+#     without asking Gemini at all
+#   - fallback: items Gemini failed on (quota used up, errors, timeouts)
+#     get the model's best guess instead of an error, as long as it has
+#     seen `fallback_examples` answers. These results carry a 'fallback'
+#     key, so the app shows them as guesses and never stores them.
+#
+# It can't write summaries, so its results show the message text itself.
+
+DEFAULT_CONFIDENCE = 0.9
+DEFAULT_MIN_EXAMPLES = 500
+DEFAULT_FALLBACK_EXAMPLES = 50
+
+# Saved to disk after this many new examples
+SAVE_EVERY = 100
+
+# New words stop being added once a kind has this many
+MAX_FEATURES = 50000
+
+LEARNING_RATE = 0.5
+
+
+def features(item):
+    """The words of a message (digits, links and addresses masked) and its sender."""
+    words = set(normalize(item['text']).split())
+    words.add('from=' + normalize_sender(item['sender']))
+    return words
+
+
+def summary_of(item):
+    """The model can't summarize: show the message itself (a conversation's newest line)."""
+    text = item['text'].strip()
+    if item.get('conversation'):
+        text = text.splitlines()[-1]
+    return short_summary(' '.join(text.split()))
+
+
+class LocalModel:
+    """TF-IDF + softmax regression per kind of message, trained online on Gemini's answers."""
+
+    def __init__(self, path=None, confidence=DEFAULT_CONFIDENCE, min_examples=DEFAULT_MIN_EXAMPLES,
+                 fallback_examples=DEFAULT_FALLBACK_EXAMPLES):
+        self.path = path
+        self.confidence = confidence
+        self.min_examples = min_examples
+        self.fallback_examples = fallback_examples
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # One save at a time
+        self._unsaved = 0
+        # {kind: {'labels': [...], 'bias': [...], 'weights': {word: [...]}, 'df': {word: n}, 'examples': n}}
+        self.kinds = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.kinds = json.load(f)
+            except (OSError, ValueError) as e:
+                # A broken file must not stop the app from starting: learn again from scratch
+                print(f"Could not read the local model at {path}, starting empty: {e}")
+
+    def _vector(self, model, words):
+        """TF-IDF weights of the known words, scaled to length 1."""
+        docs = model['examples']
+        vector = {}
+        for word in words:
+            df = model['df'].get(word)
+            if df:
+                vector[word] = math.log((docs + 1) / (df + 1)) + 1
+        norm = math.sqrt(sum(value * value for value in vector.values())) or 1.0
+        return {word: value / norm for word, value in vector.items()}
+
+    def _probabilities(self, model, vector):
+        scores = list(model['bias'])
+        for word, value in vector.items():
+            for i, weight in enumerate(model['weights'][word]):
+                scores[i] += weight * value
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def predict(self, kind, item):
+        """Returns (priority, probability), or None if nothing was learned for this kind yet."""
+        with self._lock:
+            model = self.kinds.get(kind)
+            if not model or not model['examples']:
+                return None
+            probabilities = self._probabilities(model, self._vector(model, features(item)))
+            best = max(range(len(probabilities)), key=probabilities.__getitem__)
+            return model['labels'][best], probabilities[best]
+
+    def learn(self, kind, items, results):
+        """One training step for every item Gemini answered."""
+        learned = 0
+        with self._lock:
+            model = self.kinds.setdefault(kind, {'labels': [], 'bias': [], 'weights': {}, 'df': {}, 'examples': 0})
+            for item in items:
+                result = results.get(item['id'])
+                if not result or 'error' in result or 'fallback' in result:
+                    continue
+                label = result['priority']
+                if label not in model['labels']:
+                    model['labels'].append(label)
+                    model['bias'].append(0.0)
+                    for weights in model['weights'].values():
+                        weights.append(0.0)
+
+                words = features(item)
+                model['examples'] += 1
+                for word in words:
+                    if word in model['df']:
+                        model['df'][word] += 1
+                    elif len(model['df']) < MAX_FEATURES:
+                        model['df'][word] = 1
+                        model['weights'][word] = [0.0] * len(model['labels'])
+
+                # Gradient of the log loss: (probability - 1 for the right label, else probability)
+                vector = self._vector(model, words)
+                probabilities = self._probabilities(model, vector)
+                rate = LEARNING_RATE / math.sqrt(1 + model['examples'] / 1000)
+                target = model['labels'].index(label)
+                for i, probability in enumerate(probabilities):
+                    gradient = probability - (1.0 if i == target else 0.0)
+                    model['bias'][i] -= rate * gradient
+                    for word, value in vector.items():
+                        model['weights'][word][i] -= rate * gradient * value
+                learned += 1
+
+            self._unsaved += learned
+            should_save = self.path and self._unsaved >= SAVE_EVERY
+        if should_save:
+            self.save()
+
+    def _result(self, item, priority):
+        return {'priority': priority, 'from': item['sender'], 'summary': summary_of(item)}
+
+    def confident(self, kind, items):
+        """Returns {id: result} for the items the model is sure enough about to skip Gemini."""
+        model = self.kinds.get(kind)
+        if self.confidence >= 1 or not model or model['examples'] < self.min_examples:
+            return {}
+        results = {}
+        for item in items:
+            prediction = self.predict(kind, item)
+            if prediction and prediction[1] >= self.confidence:
+                results[item['id']] = self._result(item, prediction[0])
+        return results
+
+    def fallback(self, kind, item, error):
+        """The model's best guess for an item Gemini failed on, or None if it knows too little."""
+        model = self.kinds.get(kind)
+        if not model or model['examples'] < self.fallback_examples:
+            return None
+        prediction = self.predict(kind, item)
+        if prediction is None:
+            return None
+        return dict(self._result(item, prediction[0]), fallback=error)
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                data = json.dumps(self.kinds)
+                self._unsaved = 0
+            # Write a temp file and rename it, so a crash never leaves half a model.
+            # Other workers may save the same file, so the temp name is ours alone.
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+
+    def stats(self):
+        """How many examples it has learned from, per kind."""
+        with self._lock:
+            return {kind: model['examples'] for kind, model in self.kinds.items()}
@@ -0,0 +1,159 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# --- METRICS ---
+#
+# A tiny in-process metrics registry, so we can see WHERE a slow page
+# spends its time (Gmail, Gemini, parsing, rendering...) without any
+# extra service. Everything is kept in plain dicts behind one lock and
+# served in the Prometheus text format at /metrics.
+#
+#   with metrics.span('gmail_list'):          # times one stage
+#       ...
+#   metrics.inc('ai_inbox_cache_lookups_total', kind='sms', result='hit')
+#
+# Spans also add up per request (for the thread handling the request), so
+# a response can carry a Server-Timing header with its own breakdown.
+
+# Histogram buckets (seconds) for stage and request timings
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_METRIC = 'ai_inbox_stage_seconds'
+
+HELP = {
+    STAGE_METRIC: 'Time spent in each stage (gmail_list, gmail_get, prompt_build, gemini_generate, parse, render...).',
+    'ai_inbox_request_seconds': 'Time to produce each response (for streams, until the first byte).',
+    'ai_inbox_requests_total': 'Responses by endpoint and status code.',
+    'ai_inbox_gemini_failures_total': 'Gemini calls that raised or returned unusable JSON.',
+    'ai_inbox_gemini_retries_total': 'Gemini calls retried by the rate limiter, by reason.',
+    'ai_inbox_cache_lookups_total': 'Classification cache lookups per item, by result.',
+    'ai_inbox_store_hits_total': 'Messages shown straight from the message store.',
+    'ai_inbox_gmail_messages_total': 'Messages fetched from Gmail, by result.',
+    'ai_inbox_gemini_call_seconds': 'Latency of each Gemini attempt that got an answer (what the hedge delay is based on).',
+    'ai_inbox_gemini_timeouts_total': 'Gemini attempts given up on at the deadline.',
+    'ai_inbox_gemini_hedges_total': 'Gemini calls that were slow enough to send again: which copy answered first, or skipped (no rate limit budget).',
+    'ai_inbox_circuit_breaker_transitions_total': 'Circuit breaker state changes, by new state.',
+    'ai_inbox_circuit_breaker_rejections_total': 'Calls the open circuit breaker kept from Gemini, by where they went.',
+    'ai_inbox_local_model_answers_total': 'Items answered by the offline model, by reason (confident or fallback).',
+}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Counters, timing histograms and per-request span totals."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}      # {(name, labels): value}
+        self.histograms = {}    # {(name, labels): [count per bucket..., sum, count]}
+        self.collectors = []
+        self._request = threading.local()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            values = self.histograms.get(key)
+            if values is None:
+                values = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    values[i] += 1
+            values[-2] += seconds
+            values[-1] += 1
+
+    @contextmanager
+    def span(self, stage):
+        """Times the block as one `stage`, both globally and for the current request."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage, seconds):
+        """Adds one timing of `stage` that was measured some other way."""
+        self.observe(STAGE_METRIC, seconds, stage=stage)
+        timings = getattr(self._request, 'timings', None)
+        if timings is not None:
+            total, count = timings.get(stage, (0.0, 0))
+            timings[stage] = (total + seconds, count + 1)
+
+    def start_request(self, timings=None):
+        """Starts collecting span totals for the request handled by this thread.
+
+        `timings` (from request_timings() in another thread) carries on
+        from what that thread collected for the same request.
+        """
+        self._request.timings = dict(timings or {})
+
+    def request_timings(self):
+        """{stage: (seconds, count)} for the current request so far."""
+        return dict(getattr(self._request, 'timings', None) or {})
+
+    def add_collector(self, collect):
+        """Registers a function returning [(name, type, help, [(labels dict, value), ...]), ...].
+
+        It is called on every scrape, for numbers other modules already keep
+        (parse stats, token usage, rule hits...).
+        """
+        self.collectors.append(collect)
+
+    def render(self):
+        """Everything, in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+
+        families = {}
+        for (name, labels), value in counters.items():
+            families.setdefault((name, 'counter', HELP.get(name, name)), []).append((name, labels, value))
+        for (name, labels), values in histograms.items():
+            samples = families.setdefault((name, 'histogram', HELP.get(name, name)), [])
+            for bound, count in zip(BUCKETS, values):
+                samples.append((name + '_bucket', labels + (('le', repr(float(bound))),), count))
+            samples.append((name + '_bucket', labels + (('le', '+Inf'),), values[-1]))
+            samples.append((name + '_sum', labels, values[-2]))
+            samples.append((name + '_count', labels, values[-1]))
+        for collect in self.collectors:
+            for name, kind, help_text, values in collect():
+                samples = families.setdefault((name, kind, help_text), [])
+                samples.extend((name, tuple(sorted(labels.items())), value) for labels, value in values)
+
+        lines = []
+        for (name, kind, help_text), samples in sorted(families.items()):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for sample_name, labels, value in samples:
+                lines.append(f'{sample_name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def server_timing(timings, total=None):
+    """Formats {stage: (seconds, count)} as a Server-Timing header value."""
+    parts = [f'{stage};dur={seconds * 1000:.1f};desc="{count}x"' for stage, (seconds, count) in sorted(timings.items())]
+    if total is not None:
+        parts.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(parts)
+
+
+# The one registry the whole app uses
+metrics = Metrics()
@@ -0,0 +1,103 @@
+import os
+import re
+
+# --- PROMPT BUILDER ---
+#
+# Every Gemini call pays for every token we send, so the prompts are kept
+# as short as they can be while saying the same thing:
+#   - the instructions are written once, with no leading indentation
+#   - JSON mode + a response schema (see classifier.py) already force the
+#     answer's shape, so we don't spell out the format at length
+#   - whitespace in senders and message bodies is collapsed, and long
+#     bodies are cut down to a token budget (ITEM_TOKEN_BUDGET)
+
+# Max (estimated) tokens of message text per item, and of the sender
+ITEM_TOKEN_BUDGET = int(os.environ.get('PROMPT_ITEM_TOKENS', 200))
+SENDER_TOKEN_BUDGET = 30
+
+# Max (estimated) tokens of a whole conversation's transcript (see threads.py)
+THREAD_TOKEN_BUDGET = int(os.environ.get('PROMPT_THREAD_TOKENS', 600))
+
+EMAIL_RULES = (
+    'Classify the email. "Alert" = bank alert, 2FA code, password reset or payment confirmation. '
+    'Otherwise "High", "Medium" or "Low" by importance.'
+)
+SMS_RULES = (
+    'Classify the SMS. "Urgent" = 2FA code, bank alert, emergency. '
+    '"Important" = personal conversation, plans. "Other" = spam, marketing, promotions.'
+)
+
+PROMPTS = {
+    'email': {
+        'single': EMAIL_RULES + '\nReply with JSON {{"priority","from","summary"}}; "from" is the sender name, "summary" one sentence.\nFrom: {sender}\nSnippet: {text}',
+        'batch': EMAIL_RULES.replace('the email', 'each email') + '\nReply with a JSON array of {{"id","priority","from","summary"}}, one per email; "from" is the sender name, "summary" one sentence.\n{items}',
+        'item': 'ID: {id}\nFrom: {sender}\nSnippet: {text}\n',
+    },
+    'sms': {
+        'single': SMS_RULES + '\nReply with JSON {{"priority","from","summary"}}; "summary" is one sentence.\nFrom: {sender}\nMessage: {text}',
+        'batch': SMS_RULES.replace('the SMS', 'each SMS') + '\nReply with a JSON array of {{"id","priority","from","summary"}}, one per SMS; "summary" is one sentence.\n{items}',
+        'item': 'ID: {id}\nFrom: {sender}\nMessage: {text}\n',
+    },
+}
+
+_WORD = re.compile(r"\w+|[^\w\s]")
+_WHITESPACE = re.compile(r'\s+')
+
+
+def estimate_tokens(text):
+    """Rough local token count, close enough for budgeting.
+
+    Gemini's tokenizer splits text into roughly 4-character pieces, but
+    short words and punctuation are a token each, so we take whichever
+    estimate is larger.
+    """
+    if not text:
+        return 0
+    return max(len(text) // 4, int(len(_WORD.findall(text)) * 0.75)) or 1
+
+
+def compact(text):
+    """Collapses runs of spaces, tabs and newlines into single spaces."""
+    return _WHITESPACE.sub(' ', text or '').strip()
+
+
+def truncate_to_budget(text, max_tokens):
+    """Cuts text down to about max_tokens, at a word boundary, marking the cut with '...'."""
+    text = compact(text)
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    # Shrink by characters until the estimate fits
+    limit = max_tokens * 4
+    while limit > 0:
+        cut = text[:limit].rsplit(' ', 1)[0] if ' ' in text[:limit] else text[:limit]
+        if estimate_tokens(cut) < max_tokens:
+            return cut + '...'
+        limit = int(limit * 0.9)
+    return '...'
+
+
+def _fields(item):
+    return {
+        'sender': truncate_to_budget(item['sender'], SENDER_TOKEN_BUDGET),
+        'text': truncate_to_budget(item['text'], THREAD_TOKEN_BUDGET if item.get('conversation') else ITEM_TOKEN_BUDGET),
+    }
+
+
+def build_single_prompt(kind, item):
+    """The prompt for one message on its own."""
+    return PROMPTS[kind]['single'].format(**_fields(item))
+
+
+def build_batch_prompt(kind, items):
+    """Builds one prompt that lists every item with a short ID (1, 2, 3...).
+
+    Short numbers are cheaper and easier for the model to copy back than
+    Gmail's long message IDs.
+    """
+    templates = PROMPTS[kind]
+    listed = "".join(
+        templates['item'].format(id=number, **_fields(item))
+        for number, item in enumerate(items, start=1)
+    )
+    return templates['batch'].format(items=listed.rstrip())
@@ -0,0 +1,219 @@
+import asyncio
+import fcntl
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from metrics import metrics
+from prompts import estimate_tokens
+
+# --- GEMINI RATE LIMITING ---
+#
+# Instead of sleeping a fixed 6 seconds after every call, we keep two
+# "token buckets": one for requests per minute and one for (estimated)
+# prompt tokens per minute. A call only waits if a bucket is empty, so
+# calls go out as fast as the quota allows and no faster.
+#
+# The buckets are shared by every thread. If a state file is given, they
+# are also shared by every gunicorn worker on the machine (the file is
+# locked while a worker reads and updates it).
+
+# Defaults match the free Gemini tier (10 requests / 250k tokens a minute)
+DEFAULT_RPM = 10
+DEFAULT_TPM = 250000
+
+# Exponential backoff settings for transient errors
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# HTTP codes / exception names worth retrying
+RETRYABLE_CODES = {429, 500, 503, 504}
+RETRYABLE_NAMES = {'ResourceExhausted', 'TooManyRequests', 'ServiceUnavailable',
+                   'InternalServerError', 'DeadlineExceeded'}
+
+
+def is_rate_limit_error(error):
+    """True if the error is a 429 / quota error."""
+    return getattr(error, 'code', None) == 429 or type(error).__name__ in ('ResourceExhausted', 'TooManyRequests')
+
+
+def is_retryable(error):
+    code = getattr(error, 'code', None)
+    return code in RETRYABLE_CODES or type(error).__name__ in RETRYABLE_NAMES
+
+
+def retry_after(error):
+    """Reads the "retry in N seconds" hint out of a 429 error, if it has one."""
+    text = str(error)
+    match = re.search(r'retry in ([\d.]+)\s*s', text, re.IGNORECASE)
+    if not match:
+        match = re.search(r'retry_delay\s*{\s*seconds:\s*(\d+)', text)
+    if match:
+        return float(match.group(1))
+    return None
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    """Exponential backoff with "full jitter" so workers don't retry in lockstep."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class RateLimiter:
+    """Token-bucket limiter for requests per minute and tokens per minute."""
+
+    def __init__(self, requests_per_minute=DEFAULT_RPM, tokens_per_minute=DEFAULT_TPM, state_file=None):
+        self.rpm = float(requests_per_minute)
+        self.tpm = float(tokens_per_minute)
+        self.state_file = state_file
+        self._lock = threading.Lock()
+        self._state = self._full_state()
+
+    @classmethod
+    def from_env(cls):
+        """Builds a limiter from GEMINI_RPM, GEMINI_TPM and GEMINI_RATE_FILE."""
+        return cls(
+            requests_per_minute=float(os.environ.get('GEMINI_RPM', DEFAULT_RPM)),
+            tokens_per_minute=float(os.environ.get('GEMINI_TPM', DEFAULT_TPM)),
+            state_file=os.environ.get('GEMINI_RATE_FILE') or None,
+        )
+
+    def _full_state(self):
+        return {'requests': self.rpm, 'tokens': self.tpm, 'updated': time.time(), 'blocked_until': 0.0}
+
+    @contextmanager
+    def _locked_state(self):
+        """Yields the bucket state while holding the thread (and file) lock."""
+        with self._lock:
+            if not self.state_file:
+                yield self._state
+                return
+
+            with open(self.state_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0)
+                    try:
+                        state = json.loads(f.read())
+                    except ValueError:
+                        state = self._full_state()
+                    yield state
+                    f.seek(0)
+                    f.truncate()
+                    f.write(json.dumps(state))
+                    f.flush()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _refill(self, state, now):
+        elapsed = max(0.0, now - state['updated'])
+        state['requests'] = min(self.rpm, state['requests'] + elapsed * self.rpm / 60)
+        state['tokens'] = min(self.tpm, state['tokens'] + elapsed * self.tpm / 60)
+        state['updated'] = now
+
+    def acquire(self, tokens=1):
+        """Blocks until one request (and `tokens` tokens) may be sent."""
+        # A single prompt bigger than the whole budget would wait forever
+        tokens = min(tokens, self.tpm)
+
+        while True:
+            with self._locked_state() as state:
+                now = time.time()
+                self._refill(state, now)
+
+                if now < state['blocked_until']:
+                    wait = state['blocked_until'] - now
+                elif state['requests'] >= 1 and state['tokens'] >= tokens:
+                    state['requests'] -= 1
+                    state['tokens'] -= tokens
+                    return
+                else:
+                    wait_requests = (1 - state['requests']) * 60 / self.rpm
+                    wait_tokens = (tokens - state['tokens']) * 60 / self.tpm
+                    wait = max(wait_requests, wait_tokens, 0.01)
+
+            with metrics.span('rate_limit_wait'):
+                time.sleep(wait)
+
+    def try_acquire(self, tokens=1):
+        """Takes one request (and `tokens` tokens) if the buckets have them right now; never waits.
+
+        Returns True if it did.
+        """
+        tokens = min(tokens, self.tpm)
+        with self._locked_state() as state:
+            now = time.time()
+            self._refill(state, now)
+            if now < state['blocked_until'] or state['requests'] < 1 or state['tokens'] < tokens:
+                return False
+            state['requests'] -= 1
+            state['tokens'] -= tokens
+            return True
+
+    def block_for(self, seconds):
+        """Pauses every caller for `seconds` (used when Gemini says "retry in N s")."""
+        with self._locked_state() as state:
+            state['blocked_until'] = max(state['blocked_until'], time.time() + seconds)
+
+    def call(self, fn, tokens=1, max_retries=MAX_RETRIES):
+        """Runs fn() under the limiter, retrying 429s and transient errors."""
+        for attempt in range(max_retries + 1):
+            self.acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                if attempt == max_retries or not is_retryable(e):
+                    raise
+
+                metrics.inc('ai_inbox_gemini_retries_total', reason='rate_limit' if is_rate_limit_error(e) else 'transient')
+                hint = retry_after(e) if is_rate_limit_error(e) else None
+                if hint is not None:
+                    # The server told us how long; everyone should wait that long
+                    self.block_for(hint + random.uniform(0, 1))
+                else:
+                    time.sleep(backoff_delay(attempt))
+
+    async def call_async(self, fn, tokens=1, max_retries=MAX_RETRIES):
+        """Like call(), but for async code: fn() returns an awaitable.
+
+        Waiting for the bucket happens in a worker thread so the event loop
+        keeps serving other calls meanwhile.
+        """
+        for attempt in range(max_retries + 1):
+            await asyncio.to_thread(self.acquire, tokens)
+            try:
+                return await fn()
+            except Exception as e:
+                if attempt == max_retries or not is_retryable(e):
+                    raise
+
+                metrics.inc('ai_inbox_gemini_retries_total', reason='rate_limit' if is_rate_limit_error(e) else 'transient')
+                hint = retry_after(e) if is_rate_limit_error(e) else None
+                if hint is not None:
+                    self.block_for(hint + random.uniform(0, 1))
+                else:
+                    await asyncio.sleep(backoff_delay(attempt))
+
+
+class RateLimitedModel:
+    """Wraps a Gemini model so every generate_content call goes through a limiter."""
+
+    def __init__(self, model, limiter):
+        self.model = model
+        self.limiter = limiter
+
+    def generate_content(self, prompt, **kwargs):
+        return self.limiter.call(
+            lambda: self.model.generate_content(prompt, **kwargs),
+            tokens=estimate_tokens(prompt),
+        )
+
+    async def generate_content_async(self, prompt, **kwargs):
+        return await self.limiter.call_async(
+            lambda: self.model.generate_content_async(prompt, **kwargs),
+            tokens=estimate_tokens(prompt),
+        )
@@ -0,0 +1,281 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+from metrics import metrics
+from prompts import estimate_tokens
+
+# --- GEMINI RESILIENCE ---
+#
+# One slow or hung Gemini call used to hold up a whole page, and when
+# Gemini was down every call still paid its full latency (plus retries).
+# Two wrappers, used like RateLimitedModel (see app.py for the stack).
+# They only wrap generate_content_async, the one the classifier uses:
+#
+#   HedgedModel: goes right around the real model, so it sees each attempt
+#     - a deadline: an attempt that takes longer than `deadline` seconds is
+#       given up on (CallTimedOut, which is not retried)
+#     - hedging: if an attempt is still running after the p95 of recent
+#       call latencies, the same request is sent once more and whichever
+#       answers first wins. Only the slowest ~5% of calls are doubled, and
+#       a twin costs a rate limiter request like any other call: it is only
+#       sent if the limiter has one to spare right now, so hedging never
+#       pushes us over the Gemini quota.
+#     The latencies it learns from are exported as ai_inbox_gemini_call_seconds.
+#     It also reports every attempt to the circuit breaker, and once the
+#     breaker is open it refuses further attempts (CircuitOpen, which is
+#     not retried), so calls stop retrying as soon as it opens.
+#
+#   CircuitBreakerModel: goes around everything (including the rate
+#     limiter), so when it is open calls fail at once instead of queueing.
+#     When at least `failure_rate` of the last `window` attempts failed, it
+#     opens for `cooldown` seconds: calls go to the `fallback` model if
+#     there is one (e.g. a cheaper Gemini model), else they fail straight
+#     away (and the offline model in local_model.py answers instead).
+#     After the cooldown a single trial call decides whether it closes.
+
+DEFAULT_DEADLINE = 30
+HEDGE_QUANTILE = 0.95
+MIN_HEDGE_DELAY = 0.5
+
+# How many recent latencies the hedge delay is worked out from, and how
+# many it needs before it starts hedging at all
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+DEFAULT_FAILURE_RATE = 0.5
+DEFAULT_MIN_CALLS = 10
+DEFAULT_WINDOW = 20
+DEFAULT_COOLDOWN = 30
+
+
+class CallTimedOut(Exception):
+    """Gemini did not answer within the deadline."""
+
+
+class CircuitOpen(Exception):
+    """Gemini has been failing; it is not being called for now."""
+
+
+class LatencyTracker:
+    """The latest call latencies, for working out percentiles."""
+
+    def __init__(self, name, size=LATENCY_WINDOW):
+        self.name = name
+        self._lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+
+    def observe(self, seconds):
+        metrics.observe('ai_inbox_gemini_call_seconds', seconds, model=self.name)
+        with self._lock:
+            self.samples.append(seconds)
+
+    def quantile(self, q):
+        """The q-quantile of the recent latencies, or None if there are too few of them."""
+        with self._lock:
+            samples = sorted(self.samples)
+        if len(samples) < MIN_LATENCY_SAMPLES:
+            return None
+        return samples[int(q * (len(samples) - 1))]
+
+
+class HedgedModel:
+    """Gives every attempt a deadline, and re-sends the slowest ones (see above)."""
+
+    def __init__(self, model, deadline=DEFAULT_DEADLINE, hedge_quantile=HEDGE_QUANTILE,
+                 min_hedge_delay=MIN_HEDGE_DELAY, name='gemini', limiter=None, breaker=None):
+        self.model = model
+        self.limiter = limiter  # Every twin takes a request from it (see RateLimiter.try_acquire)
+        self.breaker = breaker  # Told how every attempt went
+        self.deadline = deadline
+        self.hedge_quantile = hedge_quantile  # None: never hedge
+        self.min_hedge_delay = min_hedge_delay
+        self.name = name
+        self.latencies = LatencyTracker(name)
+
+    def hedge_delay(self):
+        """Seconds after which a still running call gets a twin, or None."""
+        if self.hedge_quantile is None:
+            return None
+        delay = self.latencies.quantile(self.hedge_quantile)
+        if delay is None or delay >= self.deadline:
+            return None
+        return max(delay, self.min_hedge_delay)
+
+    def _timed_out(self):
+        metrics.inc('ai_inbox_gemini_timeouts_total', model=self.name)
+        return CallTimedOut(f"No answer from Gemini within {self.deadline:g}s.")
+
+    def _may_hedge(self, prompt):
+        """True if the rate limiter can pay for a twin right now."""
+        if self.limiter is None or self.limiter.try_acquire(estimate_tokens(prompt)):
+            return True
+        metrics.inc('ai_inbox_gemini_hedges_total', model=self.name, result='skipped')
+        return False
+
+    def _hedged(self, hedge, winner):
+        if hedge is not None:
+            metrics.inc('ai_inbox_gemini_hedges_total', model=self.name, result='won' if winner is hedge else 'lost')
+
+    async def _call_async(self, prompt, kwargs):
+        start = time.perf_counter()
+        response = await self.model.generate_content_async(prompt, **kwargs)
+        self.latencies.observe(time.perf_counter() - start)
+        return response
+
+    async def generate_content_async(self, prompt, **kwargs):
+        if self.breaker is None:
+            return await self._attempt(prompt, kwargs)
+        if self.breaker.is_open():
+            # It opened while this call was being retried: stop here
+            raise CircuitOpen("Gemini has been failing, so it is not being called for a little while.")
+        try:
+            response = await self._attempt(prompt, kwargs)
+        except asyncio.CancelledError:
+            self.breaker.record(None)
+            raise
+        except Exception:
+            self.breaker.record(False)
+            raise
+        self.breaker.record(True)
+        return response
+
+    async def _attempt(self, prompt, kwargs):
+        start = time.perf_counter()
+        delay = self.hedge_delay()
+        pending = {asyncio.ensure_future(self._call_async(prompt, kwargs))}
+        hedge = None
+        error = None
+        try:
+            while True:
+                elapsed = time.perf_counter() - start
+                if elapsed >= self.deadline:
+                    raise self._timed_out()
+                timeout = self.deadline - elapsed
+                if hedge is None and delay is not None:
+                    if elapsed >= delay:
+                        if self._may_hedge(prompt):
+                            hedge = asyncio.ensure_future(self._call_async(prompt, kwargs))
+                            pending.add(hedge)
+                        delay = None  # One try per call
+                    else:
+                        timeout = min(timeout, delay - elapsed)
+
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._hedged(hedge, task)
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+        finally:
+            # The slower twin is not needed any more
+            for task in pending:
+                task.cancel()
+
+
+class CircuitBreaker:
+    """Closed -> open when too many recent attempts failed -> half open after a cooldown -> closed."""
+
+    def __init__(self, failure_rate=DEFAULT_FAILURE_RATE, min_calls=DEFAULT_MIN_CALLS, window=DEFAULT_WINDOW,
+                 cooldown=DEFAULT_COOLDOWN):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.outcomes = deque(maxlen=window)  # True = the attempt worked
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self._trial_running = False
+
+    @classmethod
+    def from_env(cls):
+        """Builds a breaker from GEMINI_BREAKER_FAILURE_RATE, GEMINI_BREAKER_MIN_CALLS and GEMINI_BREAKER_COOLDOWN."""
+        return cls(
+            failure_rate=float(os.environ.get('GEMINI_BREAKER_FAILURE_RATE', DEFAULT_FAILURE_RATE)),
+            min_calls=int(os.environ.get('GEMINI_BREAKER_MIN_CALLS', DEFAULT_MIN_CALLS)),
+            cooldown=float(os.environ.get('GEMINI_BREAKER_COOLDOWN', DEFAULT_COOLDOWN)),
+        )
+
+    def _move_to(self, state):
+        self.state = state
+        metrics.inc('ai_inbox_circuit_breaker_transitions_total', state=state)
+        print(f"Gemini circuit breaker is now {state}")
+
+    def allow(self):
+        """True if a call may go to the model now."""
+        with self._lock:
+            if self.state == 'open' and time.time() - self.opened_at >= self.cooldown:
+                self._move_to('half_open')
+            if self.state == 'half_open':
+                if self._trial_running:
+                    return False
+                self._trial_running = True
+                return True
+            return self.state == 'closed'
+
+    def is_open(self):
+        """True while calls are refused (open, and the cooldown is not over yet)."""
+        with self._lock:
+            return self.state == 'open' and time.time() - self.opened_at < self.cooldown
+
+    def release(self):
+        """Called when an allowed call is over, so a trial that never got to Gemini doesn't block the next one."""
+        with self._lock:
+            if self.state == 'half_open':
+                self._trial_running = False
+
+    def record(self, ok):
+        """Reports how one attempt went: True, False, or None if it was cancelled."""
+        with self._lock:
+            if self.state == 'half_open':
+                self._trial_running = False
+                if ok is None:
+                    return
+                if ok:
+                    self.outcomes.clear()
+                    self._move_to('closed')
+                else:
+                    self.opened_at = time.time()
+                    self._move_to('open')
+                return
+
+            if ok is None:
+                return
+            self.outcomes.append(ok)
+            failures = self.outcomes.count(False)
+            if (self.state == 'closed' and len(self.outcomes) >= self.min_calls
+                    and failures / len(self.outcomes) >= self.failure_rate):
+                self.opened_at = time.time()
+                self._move_to('open')
+
+
+class CircuitBreakerModel:
+    """Stops calling a failing model for a while (see CircuitBreaker), optionally using `fallback` instead."""
+
+    def __init__(self, model, breaker, fallback=None):
+        self.model = model
+        self.breaker = breaker
+        self.fallback = fallback
+
+    def _rejected(self):
+        route = 'fallback_model' if self.fallback is not None else 'failed'
+        metrics.inc('ai_inbox_circuit_breaker_rejections_total', route=route)
+        if self.fallback is None:
+            raise CircuitOpen("Gemini has been failing, so it is not being called for a little while.")
+        return self.fallback
+
+    async def generate_content_async(self, prompt, **kwargs):
+        # How each attempt went is recorded underneath, by HedgedModel
+        if not self.breaker.allow():
+            return await self._rejected().generate_content_async(prompt, **kwargs)
+        try:
+            return await self.model.generate_content_async(prompt, **kwargs)
+        except CircuitOpen:
+            # It opened while this call was being retried
+            return await self._rejected().generate_content_async(prompt, **kwargs)
+        finally:
+            self.breaker.release()
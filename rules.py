@@ -0,0 +1,139 @@
+import json
+import re
+import threading
+
+# --- LOCAL RULES (before we ask Gemini) ---
+#
+# A lot of messages don't need an AI to be sorted: OTP codes, bank debit
+# alerts, password resets and promotional blasts all look the same every
+# time. These rules catch the obvious ones with a few regexes, so only
+# the ambiguous messages cost a Gemini call.
+#
+# Rules can be replaced with a JSON file (RULES_PATH) using the same shape
+# as DEFAULT_RULES below. For each kind of message:
+#   - "allow_senders": senders (regex) that always go to the AI, e.g. family
+#   - "deny_senders":  senders (regex) that are always the lowest priority
+#   - "rules": checked in order, the first match wins. A rule matches when
+#     its "sender" and/or "text" regex both match (case-insensitive).
+
+DEFAULT_RULES = {
+    'email': {
+        'allow_senders': [],
+        'deny_senders': [],
+        'lowest_priority': 'Low',
+        'rules': [
+            {'name': 'otp', 'priority': 'Alert', 'summary': 'One-time / verification code.',
+             'text': r'\b(otp|one[- ]time (password|passcode|code)|verification code|security code|2fa code|login code)\b'},
+            {'name': 'password_reset', 'priority': 'Alert', 'summary': 'Password reset request.',
+             'text': r'\b(reset your password|password reset|password (was|has been) changed)\b'},
+            {'name': 'bank_alert', 'priority': 'Alert', 'summary': 'Bank / payment alert.',
+             'text': r'\b(has been (debited|credited)|debited (from|by|with)|credited (to|with)|payment (received|confirmation|successful)|transaction alert)\b'},
+        ],
+    },
+    'sms': {
+        'allow_senders': [],
+        'deny_senders': [],
+        'lowest_priority': 'Other',
+        'rules': [
+            {'name': 'otp', 'priority': 'Urgent', 'summary': 'One-time / verification code.',
+             'text': r'\b(otp|one[- ]time (password|passcode|code)|verification code|security code)\b'},
+            {'name': 'bank_alert', 'priority': 'Urgent', 'summary': 'Bank / payment alert.',
+             'text': r'\b(a/c|acct|account)\b.*\b(debited|credited)\b|\b(debited|credited)\b.*\b(a/c|acct|account)\b'},
+            {'name': 'promotion', 'priority': 'Other', 'summary': 'Promotional message.',
+             'text': r'\b(\d+% off|flat \d+|cashback|discount|sale ends|offer valid|use code|limited time offer|unsubscribe)\b'},
+            {'name': 'promo_short_code', 'priority': 'Other', 'summary': 'Promotional message.',
+             'sender': r'^[A-Z]{2}-[A-Z0-9]{3,8}$',
+             'text': r'\b(offer|sale|deal|shop now|buy now|win|free)\b'},
+        ],
+    },
+}
+
+
+def load_rules(path=None):
+    """Reads rules from a JSON file, or returns the built-in ones."""
+    if not path:
+        return DEFAULT_RULES
+    with open(path) as f:
+        return json.load(f)
+
+
+def _compile(pattern):
+    return re.compile(pattern, re.IGNORECASE) if pattern else None
+
+
+class RuleClassifier:
+    """Decides the easy cases locally and counts how much traffic it absorbed."""
+
+    def __init__(self, rules=None):
+        rules = rules or DEFAULT_RULES
+        self.kinds = {}
+        for kind, config in rules.items():
+            self.kinds[kind] = {
+                'allow': [_compile(p) for p in config.get('allow_senders', [])],
+                'deny': [_compile(p) for p in config.get('deny_senders', [])],
+                'lowest_priority': config.get('lowest_priority', 'Low'),
+                'rules': [
+                    {
+                        'name': rule['name'],
+                        'priority': rule['priority'],
+                        'summary': rule.get('summary'),
+                        'sender': _compile(rule.get('sender')),
+                        'text': _compile(rule.get('text')),
+                    }
+                    for rule in config.get('rules', [])
+                ],
+            }
+
+        self._lock = threading.Lock()
+        self.seen = 0
+        self.absorbed = 0
+        self.by_rule = {}
+
+    def classify(self, kind, item):
+        """Returns a result dict for an obvious message, or None if the AI should decide."""
+        config = self.kinds.get(kind)
+        if config is None:
+            return None
+
+        sender = item['sender'] or ''
+        text = item['text'] or ''
+        decision = None
+
+        if any(p.search(sender) for p in config['allow']):
+            decision = None
+        elif any(p.search(sender) for p in config['deny']):
+            decision = ('deny_senders', config['lowest_priority'], None)
+        else:
+            for rule in config['rules']:
+                if rule['sender'] and not rule['sender'].search(sender):
+                    continue
+                if rule['text'] and not rule['text'].search(text):
+                    continue
+                decision = (rule['name'], rule['priority'], rule['summary'])
+                break
+
+        with self._lock:
+            self.seen += 1
+            if decision:
+                self.absorbed += 1
+                self.by_rule[decision[0]] = self.by_rule.get(decision[0], 0) + 1
+
+        if not decision:
+            return None
+        name, priority, summary = decision
+        return {
+            'priority': priority,
+            'from': sender,
+            'summary': summary or (text[:120] + ('...' if len(text) > 120 else '')),
+            'rule': name,
+        }
+
+    def stats(self):
+        """How much of the traffic the rules handled without the AI."""
+        with self._lock:
+            return {
+                'seen': self.seen,
+                'absorbed': self.absorbed,
+                'absorbed_fraction': self.absorbed / self.seen if self.seen else 0.0,
+                'by_rule': dict(self.by_rule),
+            }
@@ -0,0 +1,127 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+from rate_limiter import RateLimiter
+
+# --- BACKGROUND PRE-CLASSIFICATION ---
+#
+# Instead of doing all the work when someone opens their summaries, this
+# scheduler visits every user with a stored refresh token every `interval`
+# seconds, pulls what is new in their inbox and classifies it. The
+# summaries page then just reads the stored results.
+#
+#   - Fairness: a user is never queued twice, and the users who waited the
+#     longest (or asked for a refresh) go first. At most `workers` users
+#     run at the same time, so one huge inbox can't starve the others.
+#   - Global quota: no more than `runs_per_minute` runs start per minute,
+#     on top of the Gemini rate limiter every call already goes through.
+#
+#   - Backoff: a user whose runs keep failing (e.g. they revoked our
+#     access) waits twice as long after every failure, up to MAX_BACKOFF
+#     intervals, instead of being retried every interval forever.
+#
+# interval=0 turns the periodic runs off; trigger(user) still works.
+
+DEFAULT_INTERVAL = 15 * 60
+DEFAULT_WORKERS = 2
+DEFAULT_RUNS_PER_MINUTE = 30
+
+# How often the scheduler looks for users that are due (when nothing wakes it)
+TICK = 30
+
+# A failing user waits at most this many intervals between runs
+MAX_BACKOFF = 32
+
+
+class InboxScheduler:
+    """Runs run_user(user) for every user in list_users(), periodically and fairly."""
+
+    def __init__(self, list_users, run_user, interval=DEFAULT_INTERVAL, workers=DEFAULT_WORKERS,
+                 runs_per_minute=DEFAULT_RUNS_PER_MINUTE):
+        self.list_users = list_users
+        self.run_user = run_user
+        self.interval = interval
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preclassify')
+        self.quota = RateLimiter(requests_per_minute=runs_per_minute, tokens_per_minute=runs_per_minute)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.users = {}  # {user: {'last_run', 'running', 'requested', 'error', 'failures'}}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='preclassify-scheduler', daemon=True)
+            self._thread.start()
+
+    def trigger(self, user):
+        """Asks for a run for this user as soon as a worker is free."""
+        with self._lock:
+            self._state(user)['requested'] = True
+        self._wake.set()
+
+    def status(self, user):
+        with self._lock:
+            return dict(self._state(user))
+
+    def _state(self, user):
+        return self.users.setdefault(user, {'last_run': None, 'running': False, 'requested': False, 'error': None,
+                                            'failures': 0})
+
+    def _loop(self):
+        while True:
+            try:
+                self._schedule_due()
+            except Exception as e:
+                print(f"Pre-classification scheduler error: {e}")
+            self._wake.wait(TICK)
+            self._wake.clear()
+
+    def _due_users(self):
+        """Users that should run now, the most overdue first."""
+        known = set(self.list_users()) if self.interval else set()
+        now = time.time()
+        with self._lock:
+            known.update(user for user, state in self.users.items() if state['requested'])
+            due = []
+            for user in known:
+                state = self._state(user)
+                if state['running']:
+                    continue
+                wait = self.interval * min(2 ** state['failures'], MAX_BACKOFF)
+                periodic_due = self.interval and (state['last_run'] is None or now - state['last_run'] >= wait)
+                if state['requested'] or periodic_due:
+                    # Refresh requests first, then whoever has waited longest
+                    due.append((not state['requested'], state['last_run'] or 0, user))
+            running = sum(1 for state in self.users.values() if state['running'])
+        return [user for _, _, user in sorted(due)][:max(0, self.workers - running)]
+
+    def _schedule_due(self):
+        for user in self._due_users():
+            self.quota.acquire()
+            with self._lock:
+                state = self._state(user)
+                state['running'] = True
+                state['requested'] = False
+            self.executor.submit(self._run, user)
+
+    def _run(self, user):
+        error = None
+        try:
+            with metrics.span('preclassify'):
+                self.run_user(user)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            print(f"Pre-classification failed for {user}: {error}")
+        metrics.inc('ai_inbox_preclassify_runs_total', result='error' if error else 'ok')
+
+        with self._lock:
+            state = self._state(user)
+            state['running'] = False
+            state['last_run'] = time.time()
+            state['error'] = error
+            state['failures'] = state['failures'] + 1 if error else 0
+        # A worker is free: see if someone else is waiting
+        self._wake.set()
@@ -0,0 +1,189 @@
+import json
+import os
+import random
+import secrets
+import sqlite3
+import time
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+# --- SERVER-SIDE SESSIONS ---
+#
+# Flask normally puts the whole `session` dict into a signed cookie, so
+# everything in it travels with every request. Here the cookie only holds
+# a random session ID, and the data is kept on the server in a store.
+#
+# A store is anything with these three methods (the same shape as Redis
+# GET / SETEX / DEL, so a Redis store would be a few lines):
+#   get(sid)              -> dict, or None if missing or expired
+#   put(sid, data, ttl)   saves data for `ttl` seconds
+#   delete(sid)
+
+# Roughly one put() in this many also sweeps out expired sessions
+CLEANUP_EVERY = 100
+
+
+class SqliteSessionStore:
+    """Sessions in a SQLite table."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires_at ON sessions (expires_at)")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def get(self, sid):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT data FROM sessions WHERE sid = ? AND expires_at > ?", (sid, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, sid, data, ttl):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (sid, json.dumps(data), now + ttl))
+            if random.randrange(CLEANUP_EVERY) == 0:
+                conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+
+class FileSessionStore:
+    """Sessions as one small JSON file each, in a directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, sid):
+        return os.path.join(self.directory, sid + '.json')
+
+    def get(self, sid):
+        try:
+            with open(self._path(sid)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record['expires_at'] <= time.time():
+            self.delete(sid)
+            return None
+        return record['data']
+
+    def put(self, sid, data, ttl):
+        # Write a temp file and rename it, so a reader never sees half a file
+        temp_path = self._path(sid) + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'data': data, 'expires_at': time.time() + ttl}, f)
+        os.replace(temp_path, self._path(sid))
+        if random.randrange(CLEANUP_EVERY) == 0:
+            self._cleanup()
+
+    def delete(self, sid):
+        try:
+            os.remove(self._path(sid))
+        except OSError:
+            pass
+
+    def _cleanup(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                self.get(name[:-len('.json')])  # Deletes it if expired
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, data=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(data, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.old_sid = None
+
+    def regenerate(self):
+        """Moves the session to a new ID (call it on login, so an old ID can't be reused)."""
+        if self.sid and not self.new:
+            self.old_sid = self.sid
+        self.sid = new_sid()
+        self.modified = True
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+def is_valid_sid(sid):
+    # Session IDs are used as file names, so only accept what new_sid() makes
+    return bool(sid) and len(sid) <= 64 and all(c.isalnum() or c in '-_' for c in sid)
+
+
+class ServerSideSessionInterface(SessionInterface):
+    """Keeps session data in `store`; the cookie only carries the session ID."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if is_valid_sid(sid):
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.old_sid:
+            self.store.delete(session.old_sid)
+            session.old_sid = None
+
+        if not session:
+            # Emptied (e.g. logged out): forget it on both sides
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        self.store.put(session.sid, dict(session), ttl)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def store_from_env(database_path):
+    """SESSION_BACKEND=sqlite (default, in the app database) or filesystem (in SESSION_DIR)."""
+    backend = os.environ.get('SESSION_BACKEND', 'sqlite')
+    if backend == 'filesystem':
+        return FileSessionStore(os.environ.get('SESSION_DIR', 'flask_sessions'))
+    if backend == 'sqlite':
+        return SqliteSessionStore(database_path)
+    raise ValueError(f"Unknown SESSION_BACKEND: {backend}")
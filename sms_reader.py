@@ -0,0 +1,51 @@
+import xml.etree.ElementTree as ET
+
+# --- STREAMING SMS BACKUP READER ---
+#
+# ET.parse() builds the whole XML tree in memory before we can look at a
+# single message, and "SMS Backup & Restore" files can be hundreds of MB
+# (mostly MMS parts with base64 attachments). iterparse() lets us read the
+# file a piece at a time instead:
+#   - every <sms> is handed out as soon as it has been read
+#   - finished elements are cleared right away, so memory stays flat
+#   - everything inside <mms> is thrown away as it streams past
+#   - we stop reading the file once we have `limit` messages
+
+
+def iter_sms(source, limit=None):
+    """Yields the attributes of each <sms> element as a dict.
+
+    `source` is a file name or a file object opened in binary mode.
+    """
+    if limit is not None and limit <= 0:
+        return
+
+    count = 0
+    depth = 0        # How deep we are in the XML tree
+    mms_depth = 0    # How many <mms> elements we are inside of
+    root = None
+
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if root is None:
+                root = elem
+            if elem.tag == 'mms':
+                mms_depth += 1
+            continue
+
+        depth -= 1
+
+        if elem.tag == 'mms':
+            mms_depth -= 1
+        elif elem.tag == 'sms' and mms_depth == 0:
+            yield dict(elem.attrib)
+            count += 1
+            if limit is not None and count >= limit:
+                return # Don't read any more of the file
+
+        # Free the element (and its parts / attachments) as soon as we are done with it
+        elem.clear()
+        if depth == 1 and root is not None:
+            # Drop the finished top-level messages the root is still holding on to
+            root.clear()
@@ -0,0 +1,123 @@
+// --- The priority tabs on the email and SMS results pages ---
+//
+// The page tells us what to do with data- attributes on #results:
+//   data-buckets     the tabs, e.g. "high,medium,low,alert"
+//   data-noun        "emails" or "messages", for the progress text
+//   data-stream-url  listen to a Server-Sent Events stream of cards, or
+//   data-job-url     poll a background job for new cards
+
+function openTab(bucket) {
+    for (const content of document.querySelectorAll(".tab-content")) {
+        content.classList.toggle("active", content.id === bucket + "-tab");
+    }
+    for (const button of document.querySelectorAll(".tab-button")) {
+        button.classList.toggle("active", button.dataset.tab === bucket);
+    }
+}
+
+function addCard(list, html, position) {
+    const empty = list.querySelector(".empty");
+    if (empty) {
+        empty.remove();  // Remove the "No ... found" text
+    }
+    const card = document.createElement("div");
+    card.className = "email";
+    card.innerHTML = html;
+    if (position === undefined) {
+        list.appendChild(card);
+        return;
+    }
+    // Keep the inbox order, even though cards arrive in any order
+    card.dataset.position = position;
+    const next = Array.from(list.children).find(c => Number(c.dataset.position) > position);
+    list.insertBefore(card, next || null);
+}
+
+// --- Listen for each card as soon as the server has classified it ---
+function listen(streamUrl, noun) {
+    const progress = document.getElementById("progress");
+    const source = new EventSource(streamUrl);
+
+    source.addEventListener("card", event => {
+        const data = JSON.parse(event.data);
+        addCard(document.getElementById(data.bucket + "-list"), data.html, data.position);
+        progress.textContent = "Summarized " + data.done + " of " + data.total + " " + noun + "...";
+    });
+    source.addEventListener("done", () => {
+        source.close();
+        progress.textContent = "Done!";
+    });
+    source.addEventListener("failure", event => {
+        source.close();
+        progress.textContent = "Error: " + JSON.parse(event.data).message;
+    });
+    // The connection dropped before "done". Don't let EventSource reconnect:
+    // that would start the whole stream again and send every card twice.
+    source.addEventListener("error", () => {
+        source.close();
+        progress.textContent = "The connection was lost. Reload the page to get the rest.";
+    });
+}
+
+// --- Ask the server how the job is going, and add new cards as they arrive ---
+function poll(jobUrl, buckets, noun) {
+    const progress = document.getElementById("progress");
+    const shown = {};  // How many cards of each tab we already have
+    for (const bucket of buckets) {
+        shown[bucket] = 0;
+    }
+
+    function pollJob() {
+        fetch(jobUrl + "?" + new URLSearchParams(shown))
+            .then(response => {
+                if (!response.ok) {
+                    // The job is gone (e.g. the server restarted): asking again won't bring it back
+                    return response.json().catch(() => ({})).then(data => {
+                        progress.textContent = "Error: " + (data.error || "HTTP " + response.status) +
+                            " Please start again.";
+                        return null;
+                    });
+                }
+                return response.json();
+            })
+            .then(job => {
+                if (!job) {
+                    return;
+                }
+                for (const bucket of buckets) {
+                    const items = job.results[bucket];  // Only the cards we don't have yet
+                    const list = document.getElementById(bucket + "-list");
+                    for (const item of items) {
+                        addCard(list, item);
+                    }
+                    shown[bucket] += items.length;
+                }
+
+                if (job.status === "error") {
+                    progress.textContent = "Error: " + job.error;
+                } else if (job.status === "done") {
+                    progress.textContent = "Done! Classified " + job.done + " " + noun + ".";
+                } else {
+                    progress.textContent = "Classified " + job.done + " of " + (job.total || "?") + " " + noun + " so far...";
+                    setTimeout(pollJob, 2000);
+                }
+            })
+            .catch(() => setTimeout(pollJob, 5000));
+    }
+    pollJob();
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+    const results = document.getElementById("results");
+    const buckets = results.dataset.buckets.split(",");
+
+    for (const button of document.querySelectorAll(".tab-button")) {
+        button.addEventListener("click", () => openTab(button.dataset.tab));
+    }
+
+    if (results.dataset.streamUrl) {
+        listen(results.dataset.streamUrl, results.dataset.noun);
+    } else if (results.dataset.jobUrl) {
+        poll(results.dataset.jobUrl, buckets, results.dataset.noun);
+    }
+});
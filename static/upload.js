@@ -0,0 +1,107 @@
+// --- Resumable SMS backup upload ---
+//
+// Instead of posting a big backup in one request (which starts over from
+// zero if the connection drops), the file is sent to /uploads in chunks.
+// Each chunk says where it starts (Upload-Offset); after an error we ask
+// the server how much it got and carry on from there. Once it is all
+// there, the form is submitted with just the upload's ID.
+//
+// The upload ID is kept in localStorage, so picking the same file again
+// after reloading the page also resumes it.
+//
+// Without JavaScript the form simply posts the file the old way.
+
+const CHUNK_SIZE = 4 * 1024 * 1024;
+const MAX_RETRIES = 8;
+
+function sleep(ms) {
+    return new Promise(resolve => setTimeout(resolve, ms));
+}
+
+function uploadKey(file) {
+    return "upload:" + [file.name, file.size, file.lastModified].join(":");
+}
+
+async function startUpload(file) {
+    // Resume an earlier attempt at the same file, if the server still has it
+    const saved = localStorage.getItem(uploadKey(file));
+    if (saved) {
+        const response = await fetch("/uploads/" + saved);
+        if (response.ok) {
+            return {id: saved, offset: (await response.json()).offset};
+        }
+    }
+    const response = await fetch("/uploads", {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify({filename: file.name, size: file.size}),
+    });
+    if (!response.ok) {
+        throw new Error("Could not start the upload (" + response.status + ")");
+    }
+    const data = await response.json();
+    localStorage.setItem(uploadKey(file), data.upload_id);
+    return {id: data.upload_id, offset: data.offset};
+}
+
+async function sendChunk(id, file, offset) {
+    const response = await fetch("/uploads/" + id, {
+        method: "PUT",
+        headers: {"Upload-Offset": String(offset)},
+        body: file.slice(offset, offset + CHUNK_SIZE),
+    });
+    if (!response.ok && response.status !== 409) {
+        throw new Error("Upload failed (" + response.status + ")");
+    }
+    // 409: the server is somewhere else (a chunk arrived twice); it tells us where
+    return (await response.json()).offset;
+}
+
+async function uploadFile(file, progress) {
+    const upload = await startUpload(file);
+    let offset = upload.offset;
+    let retries = 0;
+    while (offset < file.size) {
+        progress.textContent = "Uploading... " + Math.floor(100 * offset / file.size) + "%";
+        try {
+            offset = await sendChunk(upload.id, file, offset);
+            retries = 0;
+        } catch (error) {
+            if (++retries > MAX_RETRIES) {
+                throw error;
+            }
+            progress.textContent = "Connection lost, retrying...";
+            await sleep(Math.min(30000, 1000 * 2 ** retries));
+            const response = await fetch("/uploads/" + upload.id).catch(() => null);
+            if (response && response.ok) {
+                offset = (await response.json()).offset;
+            }
+        }
+    }
+    return upload.id;
+}
+
+document.addEventListener("DOMContentLoaded", () => {
+    const form = document.querySelector(".upload-form");
+    const input = form.querySelector("input[type=file]");
+    const progress = document.getElementById("upload-progress");
+
+    form.addEventListener("submit", async event => {
+        const file = input.files[0];
+        if (!file || !window.fetch || form.elements.upload_id.value) {
+            return;  // Post the form as it is
+        }
+        event.preventDefault();
+        form.querySelector("button").disabled = true;
+        try {
+            form.elements.upload_id.value = await uploadFile(file, progress);
+            localStorage.removeItem(uploadKey(file));
+            input.disabled = true;  // The file is on the server already, don't send it again
+            progress.textContent = "Uploaded, starting...";
+            form.submit();
+        } catch (error) {
+            progress.textContent = error.message + ". Pick the same file and try again to resume.";
+            form.querySelector("button").disabled = false;
+        }
+    });
+});
@@ -0,0 +1,165 @@
+import sqlite3
+import time
+
+# --- CLASSIFIED MESSAGE STORAGE ---
+#
+# Every email and SMS we classify is saved here, per user. The summary
+# pages read from this table instead of asking Gemini again, and it lets
+# us show older messages and filter them by priority or sender without
+# touching Gmail at all.
+#
+# `priority` is the results page tab the message goes in:
+#   email: 'alert', 'high', 'medium', 'low'
+#   sms:   'urgent', 'important', 'other'
+#
+# A row can also be a whole conversation (see threads.py). The `threads`
+# table remembers, per conversation, which row summarizes it so far, so
+# new messages can be summarized on top of it.
+
+
+class MessageStore:
+    """SQLite table of classified messages with indexes for the summary pages."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    user TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    from_name TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    priority TEXT NOT NULL,
+                    received_at REAL,
+                    classified_at REAL NOT NULL,
+                    PRIMARY KEY (user, source, message_id)
+                )
+            """)
+            # The tabs: one priority for one user, newest first
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_messages_priority
+                ON messages (user, source, priority, received_at DESC)
+            """)
+            # "Everything from this sender"
+            conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_messages_sender
+                ON messages (user, source, sender, received_at DESC)
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS threads (
+                    user TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    thread_key TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    first_at REAL,
+                    last_at REAL,
+                    PRIMARY KEY (user, source, thread_key)
+                )
+            """)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def save_many(self, user, source, rows):
+        """Saves (or updates) classified messages.
+
+        Each row is a dict with 'message_id', 'sender', 'from_name',
+        'summary', 'priority' and 'received_at'.
+        """
+        if not rows:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (user, source, row['message_id'], row['sender'], row['from_name'],
+                     row['summary'], row['priority'], row.get('received_at'), now)
+                    for row in rows
+                ],
+            )
+
+    def get_many(self, user, source, message_ids):
+        """Returns {message_id: row} for the messages we already have."""
+        found = {}
+        # SQLite allows a limited number of "?" per query, so go in chunks
+        with self._connect() as conn:
+            for start in range(0, len(message_ids), 500):
+                chunk = message_ids[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"SELECT * FROM messages WHERE user = ? AND source = ? AND message_id IN ({placeholders})",
+                    [user, source] + list(chunk),
+                ).fetchall()
+                for row in rows:
+                    found[row['message_id']] = dict(row)
+        return found
+
+    def by_priority(self, user, source, priorities, sender=None, limit=100):
+        """Returns {priority: [row, ...]} with the newest messages first.
+
+        Each priority is its own indexed query, so a big history stays cheap.
+        """
+        results = {}
+        with self._connect() as conn:
+            for priority in priorities:
+                query = "SELECT * FROM messages WHERE user = ? AND source = ? AND priority = ?"
+                params = [user, source, priority]
+                if sender:
+                    query += " AND sender = ?"
+                    params.append(sender)
+                query += " ORDER BY received_at DESC LIMIT ?"
+                params.append(limit)
+                results[priority] = [dict(row) for row in conn.execute(query, params)]
+        return results
+
+    def save_threads(self, user, source, rows):
+        """Remembers the latest summary of each conversation.
+
+        Each row is a dict with 'thread_key', 'message_id' (the row holding
+        the summary), 'first_at' and 'last_at'. An older part of a
+        conversation never replaces a newer one.
+        """
+        if not rows:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                INSERT INTO threads VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user, source, thread_key) DO UPDATE SET
+                    message_id = excluded.message_id,
+                    first_at = excluded.first_at,
+                    last_at = excluded.last_at
+                WHERE IFNULL(excluded.last_at, 0) >= IFNULL(threads.last_at, 0)
+                """,
+                [
+                    (user, source, row['thread_key'], row['message_id'], row.get('first_at'), row.get('last_at'))
+                    for row in rows
+                ],
+            )
+
+    def latest_threads(self, user, source, thread_keys):
+        """Returns {thread_key: {'message_id', 'first_at', 'last_at', 'summary'}} for known conversations."""
+        found = {}
+        keys = list(thread_keys)
+        with self._connect() as conn:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = conn.execute(
+                    f"""
+                    SELECT t.thread_key, t.message_id, t.first_at, t.last_at, m.summary
+                    FROM threads t JOIN messages m
+                      ON m.user = t.user AND m.source = t.source AND m.message_id = t.message_id
+                    WHERE t.user = ? AND t.source = ? AND t.thread_key IN ({placeholders})
+                    """,
+                    [user, source] + chunk,
+                ).fetchall()
+                for row in rows:
+                    found[row['thread_key']] = dict(row)
+        return found
@@ -0,0 +1,59 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifier import answer_locally
+from dedup import Deduplicator
+from rules import RuleClassifier
+from threads import thread_items
+
+
+def sms(message_id, text, received_at, sent=False):
+    return {'id': message_id, 'sender': '+91 98765 43210', 'text': text, 'received_at': received_at, 'sent': sent}
+
+
+FAMILY_CHAT = [
+    sms('a', "Dad is in the hospital, come quickly", 1000),
+    sms('b', "On my way. What do you need?", 1060, sent=True),
+    sms('c', "Can you read me the OTP the bank sent?", 1120),
+]
+
+
+def test_rules_leave_conversations_to_the_ai():
+    rules = RuleClassifier()
+    items = thread_items('sms', FAMILY_CHAT)
+    assert len(items) == 1 and items[0]['conversation']
+
+    results, remaining = answer_locally('sms', items, rules=rules)
+    assert results == {}
+    assert remaining == items
+
+
+def test_stored_summary_does_not_trigger_rules_later():
+    rules = RuleClassifier()
+    # Summarized earlier with words a rule would match
+    previous = {'9876543210': {'message_id': 'thread-old', 'first_at': 1000, 'last_at': 1120,
+                               'summary': "One-time / verification code."}}
+    items = thread_items('sms', FAMILY_CHAT + [sms('d', "Doctor says he is fine now", 1500)], previous)
+    assert items[0]['text'].startswith("Earlier in this conversation: One-time / verification code.")
+
+    results, remaining = answer_locally('sms', items, rules=rules)
+    assert results == {}
+    assert remaining == items
+
+
+def test_dedup_never_groups_conversations():
+    first = thread_items('sms', FAMILY_CHAT)[0]
+    second = dict(first, id='thread-other')
+    representatives, members = Deduplicator(threshold=0.5).group([first, second])
+    assert representatives == [first, second]
+    assert members == {}
+
+
+def test_rules_still_decide_single_messages():
+    rules = RuleClassifier()
+    items = thread_items('sms', [sms('otp', "Your OTP is 482913", 1000)])
+    results, remaining = answer_locally('sms', items, rules=rules)
+    assert results['otp']['priority'] == 'Urgent'
+    assert remaining == []
@@ -0,0 +1,150 @@
+import hashlib
+import os
+import re
+
+from prompts import ITEM_TOKEN_BUDGET, THREAD_TOKEN_BUDGET, compact, estimate_tokens, truncate_to_budget
+
+# --- CONVERSATIONS ---
+#
+# A back-and-forth with one contact used to be 30 separate Gemini answers
+# and 30 one-line summaries. Instead, messages are grouped into
+# conversations first, and each conversation is classified once:
+#   - email: by Gmail threadId
+#   - SMS:   by the other person's number, split wherever nobody wrote
+#     for SMS_THREAD_GAP seconds (a chat today and one last week are two
+#     different conversations)
+#
+# A conversation becomes one classifier item whose text is the transcript,
+# oldest message first. Its ID is a hash of its messages' IDs, so it is
+# found in the message store again until a message is added or removed.
+#
+# When a conversation we already summarized gets new messages, only the
+# new ones are sent, together with the earlier summary (see
+# MessageStore.latest_threads), instead of the whole transcript again.
+#
+# A message that is alone in its conversation stays exactly as it was
+# (same ID, same text), so everything already stored for it still counts.
+#
+# Conversations always go to the AI: the local rules and the near-duplicate
+# grouping only look at single messages (one OTP line in a family chat
+# doesn't make the whole chat an OTP).
+
+SMS_THREAD_GAP = float(os.environ.get('SMS_THREAD_GAP', 6 * 3600))
+
+_NOT_DIGITS = re.compile(r'\D')
+
+
+def sms_thread_key(address):
+    """'+91 98765-43210' and '9876543210' are the same person; short codes are kept as they are."""
+    digits = _NOT_DIGITS.sub('', address or '')
+    if len(digits) >= 7:
+        return digits[-10:]
+    return (address or '').strip().lower()
+
+
+def group_messages(kind, items, gap=SMS_THREAD_GAP):
+    """Groups items into conversations: a list of (thread key, [items, oldest first])."""
+    by_key = {}
+    for item in items:
+        if kind == 'email':
+            key = item.get('thread_id') or item['id']
+        else:
+            key = sms_thread_key(item['sender'])
+        by_key.setdefault(key, []).append(item)
+
+    threads = []
+    for key, members in by_key.items():
+        members.sort(key=lambda item: item.get('received_at') or 0)
+        if kind == 'email':
+            threads.append((key, members))
+            continue
+        current = [members[0]]
+        for item in members[1:]:
+            if (item.get('received_at') or 0) - (current[-1].get('received_at') or 0) > gap:
+                threads.append((key, current))
+                current = []
+            current.append(item)
+        threads.append((key, current))
+    return threads
+
+
+def thread_id(kind, key, members):
+    ids = ','.join(sorted(item['id'] for item in members))
+    return 'thread-' + hashlib.sha1(f"{kind}|{key}|{ids}".encode('utf-8')).hexdigest()[:16]
+
+
+def speaker(kind, item):
+    if kind == 'sms':
+        return 'Me' if item.get('sent') else 'Them'
+    # 'Jane Doe <jane@example.com>' -> 'Jane Doe'
+    return item['sender'].split('<')[0].strip() or item['sender']
+
+
+def transcript(kind, members, budget=THREAD_TOKEN_BUDGET):
+    """'Them: ...' / 'Me: ...' lines, oldest first. The oldest are left out if it gets too long."""
+    lines = []
+    used = 0
+    for item in reversed(members):
+        line = f"{speaker(kind, item)}: {truncate_to_budget(item['text'], ITEM_TOKEN_BUDGET)}"
+        cost = estimate_tokens(line)
+        if lines and used + cost > budget:
+            break
+        lines.append(line)
+        used += cost
+    if len(lines) < len(members):
+        lines.append(f"({len(members) - len(lines)} earlier messages left out)")
+    return '\n'.join(reversed(lines))
+
+
+def thread_items(kind, items, previous=None, gap=SMS_THREAD_GAP):
+    """Turns items into one classifier item per conversation.
+
+    `previous` is {thread key: {'message_id', 'first_at', 'last_at', 'summary'}}
+    for conversations summarized before (see MessageStore.latest_threads). Every returned item has
+    'thread_key', 'first_at', 'last_at' and 'count' (how many messages it
+    covers), so the caller can save where each conversation got to.
+    """
+    previous = previous or {}
+    result = []
+    for key, members in group_messages(kind, items, gap):
+        first_at = members[0].get('received_at')
+        last_at = members[-1].get('received_at')
+        before = previous.get(key)
+        if before and kind == 'sms' and (first_at or 0) - (before['last_at'] or 0) > gap:
+            before = None  # A new conversation with the same person
+        new = [item for item in members if (item.get('received_at') or 0) > (before['last_at'] or 0)] if before else []
+        summarized = before is not None and before['message_id'] == thread_id(kind, key, members)
+
+        if new:
+            # Picks up where the stored summary left off: send only what is new
+            item = {
+                'id': thread_id(kind, key, members),
+                'sender': new[-1]['sender'],
+                'text': f"Earlier in this conversation: {compact(before['summary'])}\n"
+                        f"New messages, oldest first:\n{transcript(kind, new)}",
+                'conversation': True,
+            }
+            first_at = before['first_at'] or first_at
+        elif len(members) == 1 and not summarized:
+            # On its own: the message itself, unchanged
+            item = dict(members[0])
+        else:
+            item = {
+                'id': thread_id(kind, key, members),
+                'sender': members[-1]['sender'],
+                'text': f"Conversation of {len(members)} messages, oldest first:\n{transcript(kind, members)}",
+                'conversation': True,
+            }
+
+        item.update({
+            'received_at': last_at,
+            'thread_key': key,
+            'first_at': first_at,
+            'last_at': last_at,
+            'count': len(members),
+        })
+        result.append(item)
+
+    # Newest conversation first, like the inbox
+    result.sort(key=lambda item: item['last_at'] or 0, reverse=True)
+    return result
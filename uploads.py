@@ -0,0 +1,199 @@
+import gzip
+import hashlib
+import json
+import os
+import random
+import re
+import secrets
+import shutil
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+
+# --- SMS BACKUP UPLOADS ---
+#
+# SMS backups can be hundreds of MB, so they never go through memory:
+#   - every upload is written to a file in `directory` as it arrives, and
+#     the background job reads it from there
+#   - big files can be sent in chunks (see static/upload.js). Each chunk
+#     says where it starts (Upload-Offset), so when the connection drops
+#     the browser asks how much arrived and carries on from there.
+#   - backups may be compressed with gzip (.gz), zip (.zip) or zstd (.zst).
+#     They are stored as they are and decompressed on the fly while the
+#     XML is read (zstd uses the `zstandard` package from requirements.txt).
+#
+# Uploads that were never finished or used are deleted after `ttl` seconds.
+
+DEFAULT_TTL = 24 * 3600
+
+# Roughly one new upload in this many also sweeps out the old ones
+CLEANUP_EVERY = 100
+
+# Bytes copied at a time
+COPY_SIZE = 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+_UPLOAD_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def _read_errors():
+    errors = (ET.ParseError, OSError, EOFError, zipfile.BadZipFile, zlib.error)
+    try:
+        import zstandard
+        errors += (zstandard.ZstdError,)
+    except ImportError:
+        pass
+    return errors
+
+
+# What reading a broken (or not really compressed) backup can raise
+BACKUP_READ_ERRORS = _read_errors()
+
+
+def open_backup(path):
+    """Opens a stored backup as a stream of XML bytes, decompressing it if needed."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rb')
+
+    if magic == ZIP_MAGIC:
+        with zipfile.ZipFile(path) as archive:
+            names = [name for name in archive.namelist() if not name.endswith('/')]
+            xml_names = [name for name in names if name.lower().endswith('.xml')]
+            if not names:
+                raise ValueError("The zip file is empty.")
+            # The member stays readable after the archive itself is closed
+            return archive.open((xml_names or names)[0])
+
+    if magic == ZSTD_MAGIC:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd backups need the zstandard package (pip install zstandard).")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+
+    return open(path, 'rb')
+
+
+def file_sha256(path):
+    """Hashes a file without reading it all into memory."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class UploadStore:
+    """Uploaded files on disk, each one sent whole or in resumable chunks."""
+
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._upload_locks = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, upload_id, suffix):
+        return os.path.join(self.directory, upload_id + suffix)
+
+    def _meta(self, upload_id):
+        try:
+            with open(self._path(upload_id, '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._upload_locks.setdefault(upload_id, threading.Lock())
+
+    def create(self, user, filename, size):
+        """Starts an upload of `size` bytes; returns its ID."""
+        upload_id = secrets.token_urlsafe(16)
+        open(self._path(upload_id, '.part'), 'wb').close()
+        with open(self._path(upload_id, '.json'), 'w') as f:
+            json.dump({'user': user, 'filename': filename, 'size': size, 'created_at': time.time()}, f)
+        if random.randrange(CLEANUP_EVERY) == 0:
+            self._cleanup()
+        return upload_id
+
+    def info(self, user, upload_id):
+        """{'filename', 'size', 'offset'} of one of this user's uploads, or None."""
+        if not _UPLOAD_ID.match(upload_id or ''):
+            return None
+        meta = self._meta(upload_id)
+        if meta is None or meta['user'] != user:
+            return None
+        try:
+            offset = os.path.getsize(self._path(upload_id, '.part'))
+        except OSError:
+            return None
+        return {'filename': meta['filename'], 'size': meta['size'], 'offset': offset}
+
+    def append(self, user, upload_id, offset, stream):
+        """Writes the chunk in `stream` at `offset`.
+
+        Returns the new offset, or None if the upload doesn't exist. If
+        `offset` is not where the upload got to (e.g. a retried chunk),
+        nothing is written and the current offset is returned.
+        """
+        with self._upload_lock(upload_id):
+            info = self.info(user, upload_id)
+            if info is None:
+                return None
+            if offset != info['offset']:
+                return info['offset']
+            with open(self._path(upload_id, '.part'), 'ab') as f:
+                remaining = info['size'] - offset
+                for block in iter(lambda: stream.read(COPY_SIZE), b''):
+                    if len(block) > remaining:
+                        # More than the size we were told: keep what fits, stop there
+                        block = block[:remaining]
+                    f.write(block)
+                    remaining -= len(block)
+                    if remaining <= 0:
+                        break
+            return info['size'] - remaining
+
+    def save(self, user, stream, filename):
+        """Writes a whole upload from `stream` in one go; returns its ID."""
+        upload_id = self.create(user, filename, 0)
+        with open(self._path(upload_id, '.part'), 'wb') as f:
+            shutil.copyfileobj(stream, f, COPY_SIZE)
+        size = os.path.getsize(self._path(upload_id, '.part'))
+        with open(self._path(upload_id, '.json'), 'w') as f:
+            json.dump({'user': user, 'filename': filename, 'size': size, 'created_at': time.time()}, f)
+        return upload_id
+
+    def path(self, user, upload_id):
+        """The file of one of this user's uploads, or None if it doesn't exist or isn't complete."""
+        info = self.info(user, upload_id)
+        if info is None or info['offset'] != info['size']:
+            return None
+        return self._path(upload_id, '.part')
+
+    def delete(self, upload_id):
+        for suffix in ('.part', '.json'):
+            try:
+                os.remove(self._path(upload_id, suffix))
+            except OSError:
+                pass
+        with self._lock:
+            self._upload_locks.pop(upload_id, None)
+
+    def _cleanup(self):
+        now = time.time()
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                upload_id = name[:-len('.json')]
+                meta = self._meta(upload_id)
+                if meta is None or now - meta['created_at'] > self.ttl:
+                    self.delete(upload_id)